@@ -1,5 +1,6 @@
 import hashlib
 from enum import Enum
+from functools import cache, cached_property
 
 import cv2
 import numpy as np
@@ -16,30 +17,88 @@ class HashAlgorithm(Enum):
     BLOCK_MEAN_1 = 7
 
 
+class FramePlanes:
+    """
+    The planes of a BGR frame that the hashing algorithms consume, each computed at most once per frame.
+
+    The OpenCV hashes resize and convert their input themselves, the average, perceptual and block mean hashes resize
+    to a fixed size before converting to grayscale, while the Marr-Hildreth and radial variance hashes convert the full
+    frame to grayscale. Handing each one a plane that has already been through exactly the same steps makes those steps
+    no-ops, so the hashes are identical to hashing the raw frame.
+    """
+
+    def __init__(self, frame: ndarray):
+        self.frame = frame
+
+    @cached_property
+    def gray(self) -> ndarray:
+        return cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY)
+
+    @cached_property
+    def resized_8(self) -> ndarray:
+        return self.resize(8)
+
+    @cached_property
+    def resized_32(self) -> ndarray:
+        return self.resize(32)
+
+    @cached_property
+    def resized_256(self) -> ndarray:
+        return self.resize(256)
+
+    def resize(self, size: int) -> ndarray:
+        return cv2.resize(self.frame, (size, size), interpolation=cv2.INTER_LINEAR_EXACT)
+
+
 hashing_algorithms = {
-    HashAlgorithm.MD5: lambda img: get_frame_hash(img, 'md5'),
-    HashAlgorithm.AVERAGE: lambda img: serialize(cv2.img_hash.averageHash(img)),
-    HashAlgorithm.PERCEPTUAL: lambda img: serialize(cv2.img_hash.pHash(img)),
-    HashAlgorithm.MARR_HILDRETH: lambda img: serialize(cv2.img_hash.marrHildrethHash(img)),
-    HashAlgorithm.RADIAL_VARIANCE: lambda img: serialize(cv2.img_hash.radialVarianceHash(img)),
-    HashAlgorithm.BLOCK_MEAN_0: lambda img: serialize(cv2.img_hash.blockMeanHash(img, mode=0)),
-    HashAlgorithm.BLOCK_MEAN_1: lambda img: serialize(cv2.img_hash.blockMeanHash(img, mode=1)),
+    HashAlgorithm.MD5: lambda planes: get_frame_hash(planes.frame, 'md5'),
+    HashAlgorithm.AVERAGE: lambda planes: serialize(cv2.img_hash.averageHash(planes.resized_8)),
+    HashAlgorithm.PERCEPTUAL: lambda planes: serialize(cv2.img_hash.pHash(planes.resized_32)),
+    HashAlgorithm.MARR_HILDRETH: lambda planes: serialize(cv2.img_hash.marrHildrethHash(planes.gray)),
+    HashAlgorithm.RADIAL_VARIANCE: lambda planes: serialize(cv2.img_hash.radialVarianceHash(planes.gray)),
+    HashAlgorithm.BLOCK_MEAN_0: lambda planes: serialize(cv2.img_hash.blockMeanHash(planes.resized_256, mode=0)),
+    HashAlgorithm.BLOCK_MEAN_1: lambda planes: serialize(cv2.img_hash.blockMeanHash(planes.resized_256, mode=1)),
 }
 
 
-def get_frame_hash(frame: ndarray, hash_algorithm: str) -> str:
+def get_frame_hash(frame: ndarray, hash_algorithm: str) -> bytes:
     hash_func = getattr(hashlib, hash_algorithm)()
-    hash_func.update(frame.tobytes())
-    return hash_func.hexdigest()
+    hash_func.update(np.ascontiguousarray(frame))
+    return hash_func.digest()
 
 
-def serialize(uint8_array: ndarray) -> str:
-    return ''.join(format(x, '02x') for x in uint8_array.flatten())
+def serialize(uint8_array: ndarray) -> bytes:
+    return uint8_array.tobytes()
 
 
-def deserialize(hex_hash: str) -> ndarray:
-    return np.array([int(hex_hash[i:i + 2], 16) for i in range(0, len(hex_hash), 2)], dtype=np.uint8)
+def deserialize(stored_hash: bytes | str) -> ndarray:
+    # tables hashed before hashes were stored as raw bytes hold hex strings instead
+    if isinstance(stored_hash, str):
+        stored_hash = bytes.fromhex(stored_hash)
+    return np.frombuffer(stored_hash, dtype=np.uint8)
+
+
+def pack_hashes(stored_hashes: list[bytes | str], width: int) -> ndarray:
+    # equal length hashes of width bytes packed into a matrix with one row per hash, which keeps its width when empty,
+    # so it can still be compared with the hashes of other editions
+    packed = b"".join(bytes.fromhex(x) if isinstance(x, str) else x for x in stored_hashes)
+    return np.frombuffer(packed, dtype=np.uint8).reshape(len(stored_hashes), width)
+
+
+@cache
+def get_hash_size(algorithm: HashAlgorithm) -> int:
+    # every hash of an algorithm is the same size, whatever the frame
+    return len(hashing_algorithms[algorithm](FramePlanes(np.zeros((32, 32, 3), dtype=np.uint8))))
+
+
+def hamming_distances(hashes_a: ndarray, hashes_b: ndarray) -> ndarray:
+    # broadcasts, so a single hash can be compared against every row of a packed matrix, as well as row by row
+    return np.bitwise_count(np.bitwise_xor(hashes_a, hashes_b)).sum(axis=-1, dtype=np.int64)
 
 
 def get_column_name(algorithm: HashAlgorithm) -> str:
     return f"hash_{algorithm.name.lower()}"
+
+
+def get_column_algorithm(column_name: str) -> HashAlgorithm:
+    return HashAlgorithm[column_name.removeprefix("hash_").upper()]
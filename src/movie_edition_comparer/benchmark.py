@@ -0,0 +1,353 @@
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import closing
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Any, Callable
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from algorithms import FramePlanes, get_column_name, hashing_algorithms
+from compare_hashes import match_all, matching_engines, read_edition_hashes, read_fused_valid_matches, \
+    read_fuzzy_valid_matches, read_hamming_index, read_scene_differences
+from database import HashWriter, configure_bulk_load, create_database, create_indexes, drop_indexes
+from hash_video import FrameSelection, get_frame_hashes, hash_video_frames_to_db
+from prepass import run_prepass
+
+maximum_prepass_fraction = 0.4 # of the frames of both editions, far more than a film with its edits spread further apart
+
+
+@dataclass
+class SyntheticScene:
+    seed: int
+    length: int
+
+
+@dataclass
+class Edit:
+    # frames from each start up to but excluding each end, with no frames in the edition without the scene
+    type: str
+    a_start: int
+    a_end: int
+    b_start: int
+    b_end: int
+
+
+def create_editions(scene_count: int, scene_length: int,
+                    seed: int) -> tuple[list[SyntheticScene], list[SyntheticScene], list[Edit]]:
+    """
+    Creates the scenes of two editions, where the second has a scene removed a quarter of the way through, a new scene
+    inserted half way through, and two scenes swapped three quarters of the way through, along with where each of
+    those edits are in both editions.
+    """
+    if scene_count < 8:
+        raise ValueError(f"Can't make every edit to {scene_count} scenes, which needs at least 8")
+
+    rng = np.random.default_rng(seed)
+    a = [SyntheticScene(int(x), scene_length + int(rng.integers(0, scene_length // 2 + 1)))
+         for x in rng.choice(2 ** 31, scene_count + 1, replace=False)]
+    a, inserted = a[:-1], a[-1]
+
+    removed_index = scene_count // 4
+    inserted_index = scene_count // 2
+    swapped_index = scene_count * 3 // 4
+    b = a[:removed_index] + a[removed_index + 1:inserted_index] + [inserted] + a[inserted_index:swapped_index] \
+        + [a[swapped_index + 1], a[swapped_index]] + a[swapped_index + 2:]
+
+    def get_start(scenes: list[SyntheticScene], scene: SyntheticScene) -> int:
+        return sum(x.length for x in scenes[:scenes.index(scene)])
+
+    removed = a[removed_index]
+    edits = [Edit("removed", get_start(a, removed), get_start(a, removed) + removed.length,
+                  get_start(b, a[removed_index + 1]), get_start(b, a[removed_index + 1])),
+             Edit("inserted", get_start(a, a[inserted_index]), get_start(a, a[inserted_index]),
+                  get_start(b, inserted), get_start(b, inserted) + inserted.length)]
+    for scene in a[swapped_index:swapped_index + 2]:
+        edits.append(Edit("reordered", get_start(a, scene), get_start(a, scene) + scene.length,
+                          get_start(b, scene), get_start(b, scene) + scene.length))
+    return a, b, edits
+
+
+def get_scene_frame(base: ndarray, index: int, width: int, height: int) -> ndarray:
+    # a smooth random image panning sideways, so consecutive frames are similar but never identical
+    return np.roll(cv2.resize(base, (width, height), interpolation=cv2.INTER_CUBIC), index * 2, axis=1)
+
+
+def write_video(path: str, scenes: list[SyntheticScene], width: int, height: int, noise: int, seed: int):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 24, (width, height))
+    rng = np.random.default_rng(seed)
+    for scene in scenes:
+        base = np.random.default_rng(scene.seed).integers(0, 256, (24, 32, 3), dtype=np.uint8)
+        for index in range(scene.length):
+            frame = get_scene_frame(base, index, width, height)
+            if noise:
+                # a different encode of the same scene is rarely pixel identical
+                frame = cv2.add(frame, rng.integers(0, noise + 1, frame.shape, dtype=np.uint8))
+            writer.write(frame)
+    writer.release()
+
+
+def read_video_frames(path: str, count: int) -> list[ndarray]:
+    cap = cv2.VideoCapture(path)
+    frames = []
+    while len(frames) < count:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+def clear_caches():
+    read_edition_hashes.cache_clear()
+    read_hamming_index.cache_clear()
+
+
+def recreate_table(db_path: str, table_name: str):
+    with closing(sqlite3.connect(db_path)) as connection:
+        connection.execute(f"DROP TABLE IF EXISTS {table_name}")
+        connection.commit()
+    create_database(db_path, table_name)
+
+
+def time_stage(stages: dict[str, dict], name: str, repeat: int, items: int, function: Callable[[], Any],
+               setup: Callable[[], Any] | None = None) -> Any:
+    # only the function is timed, with any setup, such as clearing caches, run before each repeat
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+
+    best = min(seconds)
+    stages[name] = {
+        "seconds": seconds,
+        "best": best,
+        "mean": sum(seconds) / len(seconds),
+        "items": items,
+        "items_per_second": items / best if best > 0 else None,
+    }
+    return result
+
+
+def insert_hashes(db_path: str, table_name: str, rows: list[tuple[int, dict]]):
+    with closing(sqlite3.connect(db_path)) as connection:
+        configure_bulk_load(connection)
+        drop_indexes(connection, table_name)
+        with HashWriter(connection, table_name) as writer:
+            for index, hashes in rows:
+                writer.add(index, hashes)
+
+
+def index_hashes(db_path: str, table_name: str):
+    with closing(sqlite3.connect(db_path)) as connection:
+        create_indexes(connection, table_name)
+        connection.commit()
+
+
+def unindex_hashes(db_path: str, table_name: str):
+    with closing(sqlite3.connect(db_path)) as connection:
+        drop_indexes(connection, table_name)
+        connection.commit()
+
+
+def get_row_count(db_path: str, table_name: str) -> int:
+    with closing(sqlite3.connect(db_path)) as connection:
+        return connection.execute(f"SELECT count(1) FROM {table_name}").fetchone()[0]
+
+
+def get_difference_ranges(db_path: str, a_table: str, b_table: str) -> list[tuple]:
+    clear_caches()
+    return [(x.a_range.start, x.a_range.end, x.b_range.start, x.b_range.end)
+            for x in read_scene_differences(db_path, a_table, b_table, "fuzzy")]
+
+
+def read_rows(db_path: str, table_name: str) -> dict[int, tuple]:
+    with closing(sqlite3.connect(db_path)) as connection:
+        return {x[0]: x[1:] for x in connection.execute(f"SELECT * FROM {table_name}")}
+
+
+def check_process_backend(a_path: str, db_path: str, a_table: str, workers: int) -> dict:
+    # a sparse selection with little memory reuses each shared memory slot for frames far apart, which must still be
+    # written to their own rows, as they are on the thread pool
+    process_table = "process_a"
+    recreate_table(db_path, process_table)
+    hash_video_frames_to_db(a_path, db_path, process_table, workers, 1, "process", selection=FrameSelection(2))
+
+    expected = read_rows(db_path, a_table)
+    rows = read_rows(db_path, process_table)
+    mismatched = sum(x != expected.get(index) for index, x in rows.items())
+    return {
+        "frames": len(rows),
+        "mismatched": mismatched,
+        "passed": len(rows) == len(range(0, len(expected), 2)) and mismatched == 0,
+    }
+
+
+def check_prepass(a_path: str, b_path: str, db_path: str, a_table: str, b_table: str, workers: int) -> dict:
+    # the edits are of whole scenes, whose lengths are rarely multiples of the step
+    prepass_a_table = "prepass_a"
+    prepass_b_table = "prepass_b"
+    recreate_table(db_path, prepass_a_table)
+    recreate_table(db_path, prepass_b_table)
+    regions, _ = run_prepass(a_path, prepass_a_table, b_path, prepass_b_table, db_path, 10, 5, workers, 2048)
+
+    hashed = get_row_count(db_path, prepass_a_table) + get_row_count(db_path, prepass_b_table)
+    fraction = hashed / (get_row_count(db_path, a_table) + get_row_count(db_path, b_table))
+    same_differences = get_difference_ranges(db_path, prepass_a_table, prepass_b_table) \
+        == get_difference_ranges(db_path, a_table, b_table)
+    return {
+        "regions": len(regions),
+        "hashed": hashed,
+        "fraction": fraction,
+        "same_differences": same_differences,
+        "passed": fraction < maximum_prepass_fraction and same_differences,
+    }
+
+
+def run_benchmark(directory: str, scene_count: int, scene_length: int, width: int, height: int, noise: int,
+                  sample: int, repeat: int, workers: int, seed: int) -> dict:
+    a_scenes, b_scenes, edits = create_editions(scene_count, scene_length, seed)
+    a_path = os.path.join(directory, "edition_a.avi")
+    b_path = os.path.join(directory, "edition_b.avi")
+    write_video(a_path, a_scenes, width, height, 0, seed)
+    write_video(b_path, b_scenes, width, height, noise, seed)
+
+    db_path = os.path.join(directory, "frame_hashes.db")
+    a_table = "benchmark_a"
+    b_table = "benchmark_b"
+    stages = {}
+
+    # each algorithm is given its own planes, so it pays for any resizing it needs, as it would on its own
+    frames = read_video_frames(a_path, sample)
+    for algorithm in hashing_algorithms:
+        time_stage(stages, f"hash.{get_column_name(algorithm)}", repeat, len(frames),
+                   lambda: [hashing_algorithms[algorithm](FramePlanes(x)) for x in frames])
+    rows = time_stage(stages, "get_frame_hashes", repeat, len(frames),
+                      lambda: [get_frame_hashes(index, x) for index, x in enumerate(frames)])
+
+    a_frame_count = sum(x.length for x in a_scenes)
+    b_frame_count = sum(x.length for x in b_scenes)
+    time_stage(stages, "hash_video.a", repeat, a_frame_count,
+               lambda: hash_video_frames_to_db(a_path, db_path, a_table, workers, 2048),
+               lambda: recreate_table(db_path, a_table))
+    time_stage(stages, "hash_video.b", repeat, b_frame_count,
+               lambda: hash_video_frames_to_db(b_path, db_path, b_table, workers, 2048),
+               lambda: recreate_table(db_path, b_table))
+
+    # the sampled hashes are repeated under new frame indexes, to insert as many rows as edition a has frames
+    insert_table = "benchmark_insert"
+    insert_rows = [(index, rows[index % len(rows)][1]) for index in range(a_frame_count)]
+    time_stage(stages, "insert", repeat, len(insert_rows),
+               lambda: insert_hashes(db_path, insert_table, insert_rows),
+               lambda: recreate_table(db_path, insert_table))
+    time_stage(stages, "create_indexes", repeat, len(insert_rows), lambda: index_hashes(db_path, insert_table),
+               lambda: unindex_hashes(db_path, insert_table))
+
+    anchors = {f"matches.{name}": engine for name, engine in matching_engines.items()}
+    anchors["matches.fuzzy"] = read_fuzzy_valid_matches
+    anchors["matches.fused"] = read_fused_valid_matches
+    anchor_counts = {}
+    for name, read_matches in anchors.items():
+        matches = time_stage(stages, name, repeat, a_frame_count,
+                             lambda: read_matches(db_path, a_table, b_table), clear_caches)
+        anchor_counts[name] = len(matches)
+
+    # the gaps are matched on the editions loaded into memory, so they're loaded before timing
+    matches = matching_engines["numpy"](db_path, a_table, b_table)
+    a = read_edition_hashes(db_path, a_table)
+    b = read_edition_hashes(db_path, b_table)
+    ordered = time_stage(stages, "match", repeat, len(matches), lambda: match_all(a, b, matches, 1))
+    scenes = time_stage(stages, "scenes", repeat, a_frame_count,
+                        lambda: read_scene_differences(db_path, a_table, b_table, "unique"), clear_caches)
+
+    checks = {
+        "process_backend": check_process_backend(a_path, db_path, a_table, workers),
+        "prepass": check_prepass(a_path, b_path, db_path, a_table, b_table, workers),
+    }
+
+    return {
+        "created": datetime.now().isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "sqlite": sqlite3.sqlite_version,
+        },
+        "config": {
+            "scenes": scene_count,
+            "scene_length": scene_length,
+            "width": width,
+            "height": height,
+            "noise": noise,
+            "sample": sample,
+            "repeat": repeat,
+            "workers": workers,
+            "seed": seed,
+            "a_frames": a_frame_count,
+            "b_frames": b_frame_count,
+        },
+        "edits": [asdict(x) for x in edits],
+        "anchors": anchor_counts,
+        "differences": {
+            "ordered": len(ordered),
+            "scenes": len(scenes),
+            "moved": sum(x.a_range.type == "moved" for x in scenes),
+        },
+        "stages": stages,
+        "checks": checks,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Benchmark',
+        description='Times each stage of hashing and comparing two synthetic editions with known differences'
+    )
+
+    parser.add_argument('--scenes', default=40, type=int, help="Number of scenes in the first edition")
+    parser.add_argument('--scene-length', default=24, type=int, help="Minimum number of frames in each scene")
+    parser.add_argument('--width', default=320, type=int, help="Width of each frame")
+    parser.add_argument('--height', default=240, type=int, help="Height of each frame")
+    parser.add_argument('--noise', default=2, type=int,
+                        help="Maximum value of the noise added to the second edition, to imitate a different encode")
+    parser.add_argument('--sample', default=100, type=int, help="Number of frames to time each hash algorithm on")
+    parser.add_argument('--repeat', default=3, type=int, help="Number of times to run each stage")
+    parser.add_argument('--threads', default=4, type=int, help="Number of threads to hash the videos with")
+    parser.add_argument('--seed', default=0, type=int, help="Seed for generating the scenes")
+    parser.add_argument('--dir', help="Directory to keep the videos and database in, defaults to a temporary one")
+    parser.add_argument('--output', help="Path to write the JSON results to, defaults to printing them")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        directory = args.dir or temporary_directory
+        os.makedirs(directory, exist_ok=True)
+        results = run_benchmark(directory, args.scenes, args.scene_length, args.width, args.height, args.noise,
+                                args.sample, args.repeat, args.threads, args.seed)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    failed = [name for name, x in results["checks"].items() if not x["passed"]]
+    if failed:
+        sys.exit(f"Failed checks: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,35 @@
+import argparse
 import datetime
+import itertools
 import json
 import os.path
 import sqlite3
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from contextlib import closing
 from dataclasses import dataclass
 from datetime import timedelta
+from functools import cache, cached_property
+from typing import IO, Any, Callable
 
-import cv2
 import ffmpeg
+import numpy as np
+from numpy import ndarray
 from progress.bar import Bar
 from tabulate import tabulate
 
-from algorithms import deserialize
+from algorithms import deserialize, get_column_algorithm, get_hash_size, hamming_distances, pack_hashes
+from database import get_cache_dir, get_comparable_columns, get_hash_column_types, is_hex_table, read_table_signature
+from hash_index import HammingIndex
+from metrics import instrument, metrics
+from scene_alignment import Scene, align_scenes
 
 
 @dataclass
 class HashIndex:
     index: int
-    hash: str
-
-
-def read_hashes_index(db_path: str, table_name: str, lower_index: int, upper_index: int) -> list[HashIndex]:
-    with closing(sqlite3.connect(db_path)) as connection:
-        cursor = connection.cursor()
-        cursor.execute(f"""
-            SELECT 
-                frame_index,
-                hash_block_mean_0
-            FROM
-                {table_name}
-            WHERE
-                frame_index >= {lower_index}
-                and frame_index < {upper_index}
-        """)
-        rows = cursor.fetchall()
-        return [HashIndex(*row) for row in rows]
+    hash: bytes | str
 
 
 @dataclass
@@ -45,15 +40,17 @@ class HashMatch:
 
 def read_unique_valid_matches(db_path: str, table_a_name: str, table_b_name: str) -> list[HashMatch]:
     with closing(sqlite3.connect(db_path)) as connection:
+        metrics.trace_queries(connection)
+        a_hash, b_hash = get_comparable_columns(connection, table_a_name, table_b_name, "hash_block_mean_0")
         cursor = connection.cursor()
         cursor.execute(f"""
             with a_unique as
-                     (select hash_block_mean_0 as perceptual_hash
+                     (select {a_hash} as perceptual_hash
                       from {table_a_name}
                       group by perceptual_hash
                       having count(1) = 1),
                  b_unique as
-                     (select hash_block_mean_0 as perceptual_hash
+                     (select {b_hash} as perceptual_hash
                       from {table_b_name}
                       group by perceptual_hash
                       having count(1) = 1),
@@ -64,14 +61,14 @@ def read_unique_valid_matches(db_path: str, table_a_name: str, table_b_name: str
                       select perceptual_hash
                       from b_unique),
                  matched_indexes as
-                     (select {table_a_name}.frame_index       as a_index,
-                             {table_a_name}.hash_block_mean_0 as a_perceptual_hash,
-                             {table_b_name}.frame_index       as b_index,
-                             {table_b_name}.hash_block_mean_0 as b_perceptual_hash
+                     (select {table_a_name}.frame_index as a_index,
+                             {a_hash}                   as a_perceptual_hash,
+                             {table_b_name}.frame_index as b_index,
+                             {b_hash}                   as b_perceptual_hash
                       from {table_a_name}
                                join {table_b_name}
-                                    on {table_a_name}.hash_block_mean_0 = {table_b_name}.hash_block_mean_0
-                      where {table_a_name}.hash_block_mean_0 in unique_matches),
+                                    on {a_hash} = {b_hash}
+                      where {a_hash} in unique_matches),
                  invalid_orderings as
                      (select *
                       from (select b_index                              as curr_b_index,
@@ -99,6 +96,308 @@ def read_unique_valid_matches(db_path: str, table_a_name: str, table_b_name: str
         return matches
 
 
+@dataclass
+class EditionHashes:
+    frame_indexes: ndarray
+    hashes: ndarray
+    hex_table: bool
+
+    def get_range(self, lower_index: int, upper_index: int) -> tuple[ndarray, ndarray]:
+        # slices of the loaded arrays rather than copies, for the frames from lower_index up to but excluding
+        # upper_index
+        lower = np.searchsorted(self.frame_indexes, lower_index, side="left")
+        upper = np.searchsorted(self.frame_indexes, upper_index, side="left")
+        return self.frame_indexes[lower:upper], self.hashes[lower:upper]
+
+    @cached_property
+    def unique_hashes(self) -> tuple[ndarray, ndarray]:
+        # found once per edition, however many other editions it's compared with
+        return find_unique_hashes(self.hashes)
+
+    def __getstate__(self):
+        # memory mapped arrays are sent to worker processes as their files, so every process shares the same pages
+        state = self.__dict__.copy()
+        for name in ("frame_indexes", "hashes"):
+            if isinstance(state[name], np.memmap):
+                state[name] = MappedFile(state[name].filename)
+        return state
+
+    def __setstate__(self, state: dict):
+        for name in ("frame_indexes", "hashes"):
+            if isinstance(state[name], MappedFile):
+                state[name] = np.load(state[name].path, mmap_mode="r")
+        self.__dict__.update(state)
+
+
+@dataclass
+class MappedFile:
+    path: str
+
+
+def get_edition_cache_paths(db_path: str, table_name: str, column_name: str) -> tuple[str, str, str]:
+    prefix = os.path.join(get_cache_dir(db_path), f"{table_name}_{column_name}")
+    return f"{prefix}_frame_indexes.npy", f"{prefix}_hashes.npy", f"{prefix}.json"
+
+
+def replace_file(path: str, mode: str, write: Callable[[IO], Any]):
+    # written under a name no other process is using, so processes saving the same file at once never interleave
+    handle, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path))
+    try:
+        with os.fdopen(handle, mode) as file:
+            write(file)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+def save_edition_hashes(db_path: str, table_name: str, column_name: str, edition: EditionHashes, signature: str):
+    frame_indexes_path, hashes_path, signature_path = get_edition_cache_paths(db_path, table_name, column_name)
+    os.makedirs(os.path.dirname(signature_path), exist_ok=True)
+
+    # each file is written in full before it replaces the last, and the signature last of all, so another process
+    # never maps a partly written file, or files older than the signature it read
+    for path, array in [(frame_indexes_path, edition.frame_indexes), (hashes_path, edition.hashes)]:
+        replace_file(path, "wb", lambda file: np.save(file, np.ascontiguousarray(array)))
+    replace_file(signature_path, "w", lambda file: json.dump({
+        "signature": signature,
+        "hex_table": edition.hex_table,
+        "frames": len(edition.frame_indexes),
+    }, file))
+
+
+def load_edition_hashes(db_path: str, table_name: str, column_name: str, signature: str) -> EditionHashes | None:
+    frame_indexes_path, hashes_path, signature_path = get_edition_cache_paths(db_path, table_name, column_name)
+    if not os.path.isfile(signature_path):
+        return None
+    with open(signature_path) as file:
+        cached = json.load(file)
+    if cached["signature"] != signature:
+        return None
+    try:
+        frame_indexes = np.load(frame_indexes_path, mmap_mode="r")
+        hashes = np.load(hashes_path, mmap_mode="r")
+    except (OSError, ValueError):
+        # a file removed, or cut short, since the signature was written is exported again
+        return None
+
+    # processes saving different signatures at once can leave the arrays of one beside the signature of another
+    if not len(frame_indexes) == len(hashes) == cached.get("frames"):
+        return None
+    return EditionHashes(frame_indexes, hashes, cached["hex_table"])
+
+
+def query_edition_hashes(connection: sqlite3.Connection, table_name: str, column_name: str) -> EditionHashes:
+    hex_table = is_hex_table(connection, table_name)
+    rows = connection.execute(f"""
+        SELECT frame_index, {column_name}
+        FROM {table_name}
+        WHERE {column_name} IS NOT NULL
+        ORDER BY frame_index
+    """).fetchall()
+    frame_indexes = np.array([frame_index for frame_index, _ in rows], dtype=np.int64)
+    hashes = pack_hashes([stored_hash for _, stored_hash in rows], get_hash_size(get_column_algorithm(column_name)))
+    return EditionHashes(frame_indexes, hashes, hex_table)
+
+
+@cache
+def read_edition_hashes(db_path: str, table_name: str, column_name: str = "hash_block_mean_0") -> EditionHashes:
+    """
+    Reads the hashes of a column from files exported alongside the database, which are memory mapped rather than read,
+    so loading an edition copies nothing, and processes reading the same edition share its pages. The files are
+    exported from the table whenever they're missing, or the table has changed since they were.
+    """
+    with closing(sqlite3.connect(db_path)) as connection:
+        metrics.trace_queries(connection)
+        signature = read_table_signature(connection, table_name, column_name)
+        edition = load_edition_hashes(db_path, table_name, column_name, signature)
+        if edition is not None:
+            return edition
+        edition = query_edition_hashes(connection, table_name, column_name)
+
+    # memory mapping an empty file fails, so an empty edition is read from the table every time
+    if len(edition.frame_indexes):
+        save_edition_hashes(db_path, table_name, column_name, edition, signature)
+        edition = load_edition_hashes(db_path, table_name, column_name, signature) or edition
+    return edition
+
+
+def find_unique_hashes(hashes: ndarray) -> tuple[ndarray, ndarray]:
+    # each hash viewed as a single opaque value, so rows can be sorted and compared as a whole
+    keys = hashes.view(np.dtype((np.void, hashes.shape[1]))).ravel()
+    unique_keys, rows, counts = np.unique(keys, return_index=True, return_counts=True)
+    return unique_keys[counts == 1], rows[counts == 1]
+
+
+def find_unique_matches(a: EditionHashes, b: EditionHashes) -> tuple[ndarray, ndarray]:
+    a_keys, a_unique_rows = a.unique_hashes
+    b_keys, b_unique_rows = b.unique_hashes
+    _, a_matched, b_matched = np.intersect1d(a_keys, b_keys, assume_unique=True, return_indices=True)
+    return a_unique_rows[a_matched], b_unique_rows[b_matched]
+
+
+def find_valid_matches(a: EditionHashes, b: EditionHashes,
+                       a_rows: ndarray, b_rows: ndarray) -> tuple[ndarray, ndarray]:
+    order = np.argsort(a.frame_indexes[a_rows])
+    a_rows = a_rows[order]
+    b_rows = b_rows[order]
+
+    # drop both sides of every match that goes backwards in b when ordered by a
+    b_indexes = b.frame_indexes[b_rows]
+    invalid = b_indexes[1:] < b_indexes[:-1]
+    invalid_b_indexes = np.union1d(b_indexes[1:][invalid], b_indexes[:-1][invalid])
+    valid = ~np.isin(b_indexes, invalid_b_indexes)
+    return a_rows[valid], b_rows[valid]
+
+
+def find_unique_valid_matches(a: EditionHashes, b: EditionHashes) -> tuple[ndarray, ndarray]:
+    return find_valid_matches(a, b, *find_unique_matches(a, b))
+
+
+def create_hash_matches(a: EditionHashes, b: EditionHashes, a_rows: ndarray, b_rows: ndarray) -> list[HashMatch]:
+    # match the hashes returned by the sql engine, which only converts hex hashes when comparing against raw bytes
+    hex_hashes = a.hex_table and b.hex_table
+    matches = []
+    for a_row, b_row in zip(a_rows.tolist(), b_rows.tolist()):
+        a_hash = a.hashes[a_row].tobytes()
+        b_hash = b.hashes[b_row].tobytes()
+        if hex_hashes:
+            a_hash, b_hash = a_hash.hex(), b_hash.hex()
+        matches.append(HashMatch(HashIndex(int(a.frame_indexes[a_row]), a_hash),
+                                 HashIndex(int(b.frame_indexes[b_row]), b_hash)))
+    return matches
+
+
+def read_unique_valid_matches_in_memory(db_path: str, table_a_name: str, table_b_name: str) -> list[HashMatch]:
+    a = read_edition_hashes(db_path, table_a_name)
+    b = read_edition_hashes(db_path, table_b_name)
+    return create_hash_matches(a, b, *find_unique_valid_matches(a, b))
+
+
+matching_engines = {
+    "sql": read_unique_valid_matches,
+    "numpy": read_unique_valid_matches_in_memory,
+}
+
+
+def read_shared_hash_columns(db_path: str, table_a_name: str, table_b_name: str) -> list[str]:
+    with closing(sqlite3.connect(db_path)) as connection:
+        metrics.trace_queries(connection)
+        a_columns = get_hash_column_types(connection, table_a_name)
+        b_columns = get_hash_column_types(connection, table_b_name)
+    return [x for x in a_columns if x in b_columns]
+
+
+def find_best_voted(indexes: ndarray, votes: ndarray) -> ndarray:
+    # whether each pair has strictly more votes than every other pair sharing its frame
+    order = np.lexsort((-votes, indexes))
+    sorted_indexes = indexes[order]
+    sorted_votes = votes[order]
+    same_frame = sorted_indexes[1:] == sorted_indexes[:-1]
+    first = np.concatenate([[True], ~same_frame])
+    tied = np.concatenate([same_frame & (sorted_votes[1:] == sorted_votes[:-1]), [False]])
+    best = np.empty(len(indexes), dtype=bool)
+    best[order] = first & ~tied
+    return best
+
+
+def find_fused_matches(db_path: str, table_a_name: str, table_b_name: str) -> tuple[ndarray, ndarray]:
+    """
+    Finds the unique matches of every hash column shared by both tables, returned as the frame indexes of a and of b.
+    Each column is one vote for the pair of frames it matches, and when columns disagree about the match of a frame,
+    only the pair with the most votes is kept, or none of them if the most votes are tied.
+    """
+    a_indexes = []
+    b_indexes = []
+    for column_name in read_shared_hash_columns(db_path, table_a_name, table_b_name):
+        a = read_edition_hashes(db_path, table_a_name, column_name)
+        b = read_edition_hashes(db_path, table_b_name, column_name)
+        a_rows, b_rows = find_unique_matches(a, b)
+        a_indexes.append(a.frame_indexes[a_rows])
+        b_indexes.append(b.frame_indexes[b_rows])
+
+    if not a_indexes:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    pairs, votes = np.unique(np.stack([np.concatenate(a_indexes), np.concatenate(b_indexes)]),
+                             axis=1, return_counts=True)
+    settled = find_best_voted(pairs[0], votes) & find_best_voted(pairs[1], votes)
+    return pairs[0][settled], pairs[1][settled]
+
+
+def get_rows(edition: EditionHashes, frame_indexes: ndarray) -> tuple[ndarray, ndarray]:
+    # the rows of the frames, and whether each frame has a hash in the edition at all
+    rows = np.searchsorted(edition.frame_indexes, frame_indexes)
+    found = rows < len(edition.frame_indexes)
+    found[found] = edition.frame_indexes[rows[found]] == frame_indexes[found]
+    return rows, found
+
+
+def find_fused_rows(db_path: str, table_a_name: str, table_b_name: str,
+                    a: EditionHashes, b: EditionHashes) -> tuple[ndarray, ndarray]:
+    # fused matches are found between frame indexes, so they're mapped back to the rows of the editions being matched
+    a_indexes, b_indexes = find_fused_matches(db_path, table_a_name, table_b_name)
+    a_rows, a_found = get_rows(a, a_indexes)
+    b_rows, b_found = get_rows(b, b_indexes)
+    found = a_found & b_found
+    return a_rows[found], b_rows[found]
+
+
+def read_fused_valid_matches(db_path: str, table_a_name: str, table_b_name: str) -> list[HashMatch]:
+    a = read_edition_hashes(db_path, table_a_name)
+    b = read_edition_hashes(db_path, table_b_name)
+    a_rows, b_rows = find_fused_rows(db_path, table_a_name, table_b_name, a, b)
+    return create_hash_matches(a, b, *find_valid_matches(a, b, a_rows, b_rows))
+
+
+@cache
+def read_hamming_index(db_path: str, table_name: str, column_name: str = "hash_block_mean_0") -> HammingIndex:
+    edition = read_edition_hashes(db_path, table_name, column_name)
+    with closing(sqlite3.connect(db_path)) as connection:
+        metrics.trace_queries(connection)
+        signature = read_table_signature(connection, table_name, column_name)
+
+    chunks = perceptual_match_threshold + 1
+    path = os.path.join(get_cache_dir(db_path), f"{table_name}_{column_name}_{chunks}.npz")
+    index = HammingIndex.load(path, signature)
+    if index is None:
+        index = HammingIndex(edition.hashes, chunks)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        replace_file(path, "wb", lambda file: index.save(file, signature))
+    return index
+
+
+def find_near_matches(a: EditionHashes, index_b: HammingIndex) -> tuple[ndarray, ndarray]:
+    a_rows, b_rows, a_skipped = index_b.query_all(a.hashes, perceptual_match_threshold, maximum_near_candidates)
+
+    # only frames with exactly one near frame in the other edition, in either direction, are unambiguous, which can't be
+    # known of frames sharing a chunk with too many others to search, as some of their near frames may not be found
+    a_counts = np.bincount(a_rows, minlength=len(a.hashes))
+    b_counts = np.bincount(b_rows, minlength=len(index_b.hashes))
+    b_common = index_b.find_common(maximum_near_candidates)
+    unique = (a_counts[a_rows] == 1) & (b_counts[b_rows] == 1) & ~a_skipped[a_rows] & ~b_common[b_rows]
+    return a_rows[unique], b_rows[unique]
+
+
+def find_fuzzy_matches(db_path: str, table_b_name: str, a: EditionHashes, b: EditionHashes) -> tuple[ndarray, ndarray]:
+    index_b = read_hamming_index(db_path, table_b_name)
+
+    unique_a_rows, unique_b_rows = find_unique_matches(a, b)
+    near_a_rows, near_b_rows = find_near_matches(a, index_b)
+
+    # exact matches take precedence over any near match sharing one of their frames
+    near = ~np.isin(near_a_rows, unique_a_rows) & ~np.isin(near_b_rows, unique_b_rows)
+    a_rows = np.concatenate([unique_a_rows, near_a_rows[near]])
+    b_rows = np.concatenate([unique_b_rows, near_b_rows[near]])
+    return a_rows, b_rows
+
+
+def read_fuzzy_valid_matches(db_path: str, table_a_name: str, table_b_name: str) -> list[HashMatch]:
+    a = read_edition_hashes(db_path, table_a_name)
+    b = read_edition_hashes(db_path, table_b_name)
+    a_rows, b_rows = find_fuzzy_matches(db_path, table_b_name, a, b)
+    return create_hash_matches(a, b, *find_valid_matches(a, b, a_rows, b_rows))
+
+
 def frame_to_time(frame: int) -> timedelta:
     return datetime.timedelta(seconds=frame / fps)
 
@@ -120,28 +419,26 @@ def trim_video(input_file: str, identifier: str, index: int, start: timedelta, e
     return filename
 
 
-def grab_frame(input_file: str, identifier: str, index: int, timestamp: timedelta):
-    filename = f"{output_dir}/{index}-{get_filename_time(timestamp)}-{identifier}.png"
-    if not os.path.isfile(filename):
-        (
-            ffmpeg
-            .input(input_file, ss=timestamp)
-            .output(filename, vframes=1)
-            .run(quiet=True)
-        )
+def get_frame_filename(identifier: str, index: int, timestamp: timedelta) -> str:
+    return f"{output_dir}/{index}-{get_filename_time(timestamp)}-{identifier}.png"
 
 
-def hamming_distance(hash_a: str, hash_b: str) -> float:
-    array_a = deserialize(hash_a)
-    array_b = deserialize(hash_b)
-    return cv2.norm(array_a, array_b, cv2.NORM_HAMMING)
+def grab_frame_batch(input_file: str, frames: list[tuple[str, timedelta]]):
+    # every frame is its own input, seeked to before decoding, so a batch of frames costs one ffmpeg process rather than
+    # one each, without decoding the whole file as a select filter would
+    missing = [(filename, timestamp) for filename, timestamp in frames if not os.path.isfile(filename)]
+    if missing:
+        # only the first video stream, as a remux may also carry cover art, which would be written over each frame, and
+        # a single decoder thread per input, as each input opens its own decoder and a 4K one otherwise allocates frame
+        # buffers for every core
+        outputs = [ffmpeg.input(input_file, ss=timestamp, threads=1)['v:0'].output(filename, vframes=1)
+                   for filename, timestamp in missing]
+        ffmpeg.merge_outputs(*outputs).run(quiet=True)
 
 
-def count_leading(float_list: list[float], threshold: float) -> int:
-    for i, num in enumerate(float_list):
-        if num > threshold:
-            return i
-    return len(float_list)
+def count_leading(distances: ndarray, threshold: float) -> int:
+    above = np.flatnonzero(distances > threshold)
+    return int(above[0]) if len(above) else len(distances)
 
 
 @dataclass
@@ -159,75 +456,241 @@ class HashDifference:
     range_difference: timedelta
 
 
-def match(db_path: str,
-          table_a_name: str, table_b_name: str,
-          current_match: HashMatch, previous_match: HashMatch) -> HashDifference | None:
-    previous_lag = previous_match.b.index - previous_match.a.index
-    current_lag = current_match.b.index - current_match.a.index
-    lag_difference = current_lag - previous_lag
+def is_similar_to_either(previous_hash: ndarray, current_hash: ndarray, hashes: ndarray) -> bool:
+    # whether every frame is visually similar to the match before it, or every frame is similar to the match after it
+    compared_to_previous = hamming_distances(previous_hash, hashes)
+    compared_to_current = hamming_distances(current_hash, hashes)
+    return bool(min(compared_to_previous.max(), compared_to_current.max()) <= perceptual_match_threshold)
+
+
+def find_gap_difference(a: EditionHashes, b: EditionHashes,
+                        current_match: HashMatch, previous_match: HashMatch) -> tuple[int, int, int, int] | None:
+    """
+    Narrows the gap between two matches to where frames were added to b, and returns the frames either side of it in
+    a and in b, or None if the gap holds no such difference.
+    """
+    a_indexes, a_hashes = a.get_range(previous_match.a.index + 1, current_match.a.index)
+    b_indexes, b_hashes = b.get_range(previous_match.b.index + 1, current_match.b.index)
+
+    # the distance between each pair of frames at the same offset from the start of both gaps, and from the end
+    overlap = min(len(a_hashes), len(b_hashes))
+    start_distances = hamming_distances(a_hashes[:overlap], b_hashes[:overlap])
+    end_distances = hamming_distances(a_hashes[::-1][:overlap], b_hashes[::-1][:overlap])
+
+    # the gap is narrowed from both ends for as long as the frames either side of it match, and these count how many
+    # frames have been matched from the start and from the end
+    start = 0
+    end = 0
+    previous_a = previous_match.a.index
+    previous_b = previous_match.b.index
+    current_a = current_match.a.index
+    current_b = current_match.b.index
+    while True:
+        lag_difference = (current_b - current_a) - (previous_b - previous_a)
+        if lag_difference < 1:
+            return None
+
+        a_index_range = current_a - 1 - previous_a
+        b_index_range = current_b - 1 - previous_b
+        if a_index_range < 0 or b_index_range < 0:
+            # the frames matched from the start and from the end overlap, so the shorter gap is similar to both ends
+            # of the longer one, and there's no telling where the difference is
+            return None
 
-    if lag_difference < 1:
+        a_remaining = a_hashes[start:len(a_hashes) - end]
+        b_remaining = b_hashes[start:len(b_hashes) - end]
+
+        # check if we only have frames added to b, and those frames are visually similar to its surrounding frames
+        if a_index_range == 0 and b_index_range > 0 and b_index_range < extended_similarity_threshold:
+            previous_hash = b_hashes[start - 1] if start else deserialize(previous_match.b.hash)
+            current_hash = b_hashes[len(b_hashes) - end] if end else deserialize(current_match.b.hash)
+            if is_similar_to_either(previous_hash, current_hash, b_remaining):
+                return None
+
+        # check if we only have frames added to a, and those frames are visually similar to its surrounding frames
+        if b_index_range == 0 and a_index_range > 0 and a_index_range < extended_similarity_threshold:
+            previous_hash = a_hashes[start - 1] if start else deserialize(previous_match.a.hash)
+            current_hash = a_hashes[len(a_hashes) - end] if end else deserialize(current_match.a.hash)
+            if is_similar_to_either(previous_hash, current_hash, a_remaining):
+                return None
+
+        window = min(len(a_remaining), len(b_remaining), maximum_inter_match_search)
+        start_matches = count_leading(start_distances[start:start + window], perceptual_match_threshold)
+        end_matches = count_leading(end_distances[end:end + window], perceptual_match_threshold)
+        if start_matches == 0 and end_matches == 0:
+            break
+
+        start += start_matches
+        end += end_matches
+        if start_matches > 0:
+            previous_a = int(a_indexes[start - 1])
+            previous_b = int(b_indexes[start - 1])
+        if end_matches > 0:
+            current_a = int(a_indexes[len(a_indexes) - end])
+            current_b = int(b_indexes[len(b_indexes) - end])
+
+    return previous_a, current_a, previous_b, current_b
+
+
+def match(a: EditionHashes, b: EditionHashes,
+          current_match: HashMatch, previous_match: HashMatch) -> HashDifference | None:
+    gap = find_gap_difference(a, b, current_match, previous_match)
+    if gap is None:
         return None
+    previous_a, current_a, previous_b, current_b = gap
+    a_index_range = current_a - 1 - previous_a
+    b_index_range = current_b - 1 - previous_b
 
-    a_start = frame_to_time(previous_match.a.index)
-    a_end = frame_to_time(current_match.a.index - 1)
-    a_index_range = current_match.a.index - 1 - previous_match.a.index
+    a_start = frame_to_time(previous_a)
+    a_end = frame_to_time(current_a - 1)
     a_range = frame_to_time(a_index_range)
 
-    if a_range.total_seconds() < 0:
-        # hacky, but fixes a bug, TODO fix cause
-        return None
-
-    b_start = frame_to_time(previous_match.b.index)
-    b_end = frame_to_time(current_match.b.index - 1)
-    b_index_range = current_match.b.index - 1 - previous_match.b.index
+    b_start = frame_to_time(previous_b)
+    b_end = frame_to_time(current_b - 1)
     b_range = frame_to_time(b_index_range)
 
-    if b_range.total_seconds() < 0:
-        # hacky, but fixes a bug, TODO fix cause
+    a_hash_range = HashRange(a_start, a_end, a_range, "new" if b_range == timedelta(seconds=0) else "different")
+    b_hash_range = HashRange(b_start, b_end, b_range, "new" if a_range == timedelta(seconds=0) else "different")
+    return HashDifference(a_hash_range, b_hash_range, abs(b_range - a_range))
+
+
+match_editions: tuple[EditionHashes, EditionHashes] | None = None
+
+
+def init_match_worker(a: EditionHashes, b: EditionHashes):
+    # each worker process receives the editions once, rather than with every batch of matches
+    global match_editions
+    match_editions = (a, b)
+
+
+def match_consecutive(matches: list[HashMatch]) -> tuple[list[HashDifference], list[float]]:
+    # the time taken by each gap is returned, as metrics recorded in a worker process would be lost with it
+    a, b = match_editions
+    differences = []
+    seconds = []
+    for index in range(len(matches) - 1):
+        start = time.perf_counter()
+        matched = match(a, b, matches[index + 1], matches[index])
+        seconds.append(time.perf_counter() - start)
+        if matched: differences.append(matched)
+    return differences, seconds
+
+
+def match_all(a: EditionHashes, b: EditionHashes, matches: list[HashMatch], workers: int) -> list[HashDifference]:
+    if workers <= 1 or len(matches) < 2:
+        table = []
+        with Bar('Matching', max=len(matches)) as bar:
+            for index in range(len(matches) - 1):
+                with metrics.timer("gap_seconds"):
+                    matched = match(a, b, matches[index + 1], matches[index])
+                if matched: table.append(matched)
+                bar.next()
+        return table
+
+    # every gap depends only on its own pair of matches, so the matches are split into batches which share their
+    # boundary matches, and each batch's differences are merged back in order
+    batch_count = min(len(matches) - 1, workers * 16)
+    bounds = np.linspace(0, len(matches) - 1, batch_count + 1).astype(int).tolist()
+    batches = [matches[start:end + 1] for start, end in zip(bounds, bounds[1:])]
+
+    table = []
+    with (ProcessPoolExecutor(max_workers=workers, initializer=init_match_worker, initargs=(a, b)) as executor,
+          Bar('Matching', max=len(matches)) as bar):
+        for batch, (differences, seconds) in zip(batches, executor.map(match_consecutive, batches)):
+            table.extend(differences)
+            for x in seconds:
+                metrics.observe("gap_seconds", x)
+            bar.next(len(batch) - 1)
+    return table
+
+
+def get_scene_difference(scene: Scene) -> HashDifference:
+    # like the differences found by match, each range starts at the frame before its first frame
+    a_range = frame_to_time(scene.a_end - scene.a_start)
+    b_range = frame_to_time(scene.b_end - scene.b_start)
+    a_type = scene.type if scene.type == "moved" else "new" if b_range == timedelta(seconds=0) else "different"
+    b_type = scene.type if scene.type == "moved" else "new" if a_range == timedelta(seconds=0) else "different"
+    # but a scene at the very start of an edition has no frame before it
+    a_hash_range = HashRange(frame_to_time(max(scene.a_start - 1, 0)), frame_to_time(max(scene.a_end - 1, 0)),
+                             a_range, a_type)
+    b_hash_range = HashRange(frame_to_time(max(scene.b_start - 1, 0)), frame_to_time(max(scene.b_end - 1, 0)),
+                             b_range, b_type)
+    return HashDifference(a_hash_range, b_hash_range, abs(b_range - a_range))
+
+
+def get_frame_match(a: EditionHashes, b: EditionHashes, a_index: int, b_index: int) -> HashMatch | None:
+    a_row = int(np.searchsorted(a.frame_indexes, a_index))
+    b_row = int(np.searchsorted(b.frame_indexes, b_index))
+    if a_row == len(a.frame_indexes) or a.frame_indexes[a_row] != a_index \
+            or b_row == len(b.frame_indexes) or b.frame_indexes[b_row] != b_index:
         return None
+    return HashMatch(HashIndex(a_index, a.hashes[a_row].tobytes()), HashIndex(b_index, b.hashes[b_row].tobytes()))
 
-    a_hashes = read_hashes_index(db_path, table_a_name, previous_match.a.index + 1, current_match.a.index)
-    b_hashes = read_hashes_index(db_path, table_b_name, previous_match.b.index + 1, current_match.b.index)
 
-    # check if we only have frames added to b, and those frames are visually similar to its surrounding frames
-    if a_index_range == 0 and b_index_range > 0 and b_index_range < extended_similarity_threshold:
-        b_hashes_compared_to_previous = [hamming_distance(previous_match.b.hash, b.hash) for b in b_hashes]
-        b_hashes_compared_to_current = [hamming_distance(current_match.b.hash, b.hash) for b in b_hashes]
-        if min(max(b_hashes_compared_to_previous), max(b_hashes_compared_to_current)) <= perceptual_match_threshold:
-            return None
+def swap_match(hash_match: HashMatch) -> HashMatch:
+    return HashMatch(hash_match.b, hash_match.a)
 
-    # check if we only have frames added to a, and those frames are visually similar to its surrounding frames
-    if b_index_range == 0 and a_index_range > 0 and a_index_range < extended_similarity_threshold:
-        a_hashes_compared_to_previous = [hamming_distance(previous_match.a.hash, a.hash) for a in a_hashes]
-        a_hashes_compared_to_current = [hamming_distance(current_match.a.hash, a.hash) for a in a_hashes]
-        if min(max(a_hashes_compared_to_previous), max(a_hashes_compared_to_current)) <= perceptual_match_threshold:
+
+def refine_scene_gap(a: EditionHashes, b: EditionHashes, gap: Scene) -> Scene | None:
+    # narrowed as the gap between two matches in order is, from the matched frames either side of it
+    previous_match = get_frame_match(a, b, gap.a_start - 1, gap.b_start - 1)
+    current_match = get_frame_match(a, b, gap.a_end, gap.b_end)
+    if previous_match is None and current_match is None:
+        return gap
+
+    # there's no frame before the start of an edition or after its end, so the frame the other side of the gap stands
+    # in for it
+    if previous_match is None:
+        previous_match = HashMatch(HashIndex(gap.a_start - 1, current_match.a.hash),
+                                   HashIndex(gap.b_start - 1, current_match.b.hash))
+    if current_match is None:
+        current_match = HashMatch(HashIndex(gap.a_end, previous_match.a.hash),
+                                  HashIndex(gap.b_end, previous_match.b.hash))
+
+    # only frames added to b are found, so frames removed from b are found as frames added to a
+    if gap.b_end - gap.b_start >= gap.a_end - gap.a_start:
+        found = find_gap_difference(a, b, current_match, previous_match)
+        if found is None:
+            return None
+        previous_a, current_a, previous_b, current_b = found
+    else:
+        found = find_gap_difference(b, a, swap_match(current_match), swap_match(previous_match))
+        if found is None:
             return None
+        previous_b, current_b, previous_a, current_a = found
 
-    a_start_hashes = [a.hash for a in a_hashes[:maximum_inter_match_search]]
-    a_end_hashes = [a.hash for a in a_hashes[:-1 - maximum_inter_match_search:-1]]
-    b_start_hashes = [b.hash for b in b_hashes[:maximum_inter_match_search]]
-    b_end_hashes = [b.hash for b in b_hashes[:-1 - maximum_inter_match_search:-1]]
+    scene_type = "different" if previous_a + 1 < current_a and previous_b + 1 < current_b else "new"
+    return Scene(previous_a + 1, current_a, previous_b + 1, current_b, scene_type)
 
-    start_distances = [hamming_distance(a, b) for a, b in zip(a_start_hashes, b_start_hashes)]
-    end_distances = [hamming_distance(a, b) for a, b in zip(a_end_hashes, b_end_hashes)]
 
-    start_matches = count_leading(start_distances, perceptual_match_threshold)
-    end_matches = count_leading(end_distances, perceptual_match_threshold)
+def is_similar_frame(a: EditionHashes, b: EditionHashes, a_index: int, b_index: int) -> bool:
+    frame_match = get_frame_match(a, b, a_index, b_index)
+    return frame_match is not None and \
+        hamming_distances(deserialize(frame_match.a.hash), deserialize(frame_match.b.hash)) <= perceptual_match_threshold
 
-    if start_matches > 0 or end_matches > 0:
-        new_previous_a_match = a_hashes[start_matches - 1]
-        new_previous_b_match = b_hashes[start_matches - 1]
-        new_current_a_match = a_hashes[0 - end_matches]
-        new_current_b_match = b_hashes[0 - end_matches]
-        new_previous_match = previous_match if start_matches == 0 else HashMatch(new_previous_a_match,
-                                                                                 new_previous_b_match)
-        new_current_match = current_match if end_matches == 0 else HashMatch(new_current_a_match, new_current_b_match)
-        return match(db_path, table_a_name, table_b_name, new_current_match, new_previous_match)
 
-    a_hash_range = HashRange(a_start, a_end, a_range, "new" if b_range == timedelta(seconds=0) else "different")
-    b_hash_range = HashRange(b_start, b_end, b_range, "new" if a_range == timedelta(seconds=0) else "different")
-    return HashDifference(a_hash_range, b_hash_range, abs(b_range - a_range))
+def read_scene_differences(db_path: str, table_a_name: str, table_b_name: str, anchors: str) -> list[HashDifference]:
+    a = read_edition_hashes(db_path, table_a_name)
+    b = read_edition_hashes(db_path, table_b_name)
+
+    # every unique match is kept, since matches out of order are how moved scenes are found
+    if anchors == "fuzzy":
+        a_rows, b_rows = find_fuzzy_matches(db_path, table_b_name, a, b)
+    elif anchors == "fused":
+        a_rows, b_rows = find_fused_rows(db_path, table_a_name, table_b_name, a, b)
+    else:
+        a_rows, b_rows = find_unique_matches(a, b)
+    scenes = align_scenes(a.frame_indexes[a_rows], b.frame_indexes[b_rows], get_bounds(a), get_bounds(b),
+                          lambda gap: refine_scene_gap(a, b, gap),
+                          lambda a_index, b_index: is_similar_frame(a, b, a_index, b_index))
+    return [get_scene_difference(x) for x in scenes]
+
+
+def get_bounds(edition: EditionHashes) -> tuple[int, int]:
+    # the first and last hashed frames, where an empty edition's last frame is before its first
+    if not len(edition.frame_indexes):
+        return 0, -1
+    return int(edition.frame_indexes[0]), int(edition.frame_indexes[-1])
 
 
 def get_differences_dict(hash_range: HashRange):
@@ -238,97 +701,206 @@ def get_differences_dict(hash_range: HashRange):
     }
 
 
+@dataclass
+class Edition:
+    label: str
+    table_name: str
+    movie_filename: str
+
+
+@dataclass
+class EditionDifference:
+    a: Edition
+    b: Edition
+    difference: HashDifference
+
+
+def get_edition_pairs(editions: list[Edition], reference: Edition | None) -> list[tuple[Edition, Edition]]:
+    if reference is None:
+        return list(itertools.combinations(editions, 2))
+    return [(reference, x) for x in editions if x is not reference]
+
+
+def compare_editions(db_path: str, a: Edition, b: Edition,
+                     engine: str, anchors: str, alignment: str, workers: int) -> list[HashDifference]:
+    if alignment == "scenes":
+        with metrics.timer("alignment_seconds"):
+            return read_scene_differences(db_path, a.table_name, b.table_name, anchors)
+
+    with metrics.timer("anchor_seconds"):
+        if anchors == "fuzzy":
+            matches = read_fuzzy_valid_matches(db_path, a.table_name, b.table_name)
+        elif anchors == "fused":
+            matches = read_fused_valid_matches(db_path, a.table_name, b.table_name)
+        else:
+            matches = matching_engines[engine](db_path, a.table_name, b.table_name)
+    metrics.count("anchors", len(matches))
+
+    # every gap is served from the editions loaded into memory once, rather than queried from the database
+    edition_a = read_edition_hashes(db_path, a.table_name)
+    edition_b = read_edition_hashes(db_path, b.table_name)
+    return match_all(edition_a, edition_b, matches, workers)
+
+
+def cut_differences(rows: list[EditionDifference], trim_videos: bool, grab_frames: bool,
+                    video_padding: timedelta, workers: int):
+    """
+    Trims clips around, and grabs stills at the edges of, every difference, using a pool of ffmpeg processes. The stills
+    of each movie are grabbed in batches, with each batch in a single ffmpeg process.
+    """
+    trims = []
+    frames = {}
+    for (index, row) in enumerate(rows):
+        a_start_time = row.difference.a_range.start
+        a_end_time = row.difference.a_range.end
+        a_range = row.difference.a_range.range
+        b_start_time = row.difference.b_range.start
+        b_end_time = row.difference.b_range.end
+
+        if trim_videos:
+            trims.append((row.a.movie_filename, row.a.label, index, a_start_time - video_padding, a_start_time))
+            trims.append((row.a.movie_filename, row.a.label, index, a_end_time - a_range, a_end_time + video_padding))
+            trims.append((row.b.movie_filename, row.b.label, index,
+                          b_start_time - video_padding, b_end_time + video_padding))
+
+        if grab_frames:
+            # keyed by filename, as a range with no length has the same still at its start and end
+            for edition, timestamp in [(row.a, a_start_time), (row.b, b_start_time),
+                                       (row.a, a_end_time), (row.b, b_end_time)]:
+                movie_frames = frames.setdefault(edition.movie_filename, {})
+                movie_frames[get_frame_filename(edition.label, index, timestamp)] = timestamp
+
+    batches = []
+    for movie_filename, movie_frames in frames.items():
+        movie_frames = sorted(movie_frames.items(), key=lambda x: x[1])
+        for start in range(0, len(movie_frames), maximum_frames_per_process):
+            batches.append((movie_filename, movie_frames[start:start + maximum_frames_per_process]))
+
+    with (ThreadPoolExecutor(max_workers=workers) as executor,
+          Bar('Cutting', max=len(trims) + len(batches)) as bar):
+        futures = [executor.submit(trim_video, *x) for x in trims]
+        futures += [executor.submit(grab_frame_batch, *x) for x in batches]
+        for future in as_completed(futures):
+            future.result()
+            bar.next()
+
+
 fps = 23.976216
 output_dir = "out"
 perceptual_match_threshold = 5 # when comparing perceptual hashes, anything below this hamming distance will be considered a match
 extended_similarity_threshold = 12 # how many frames to ignore between matches, if they are similar to the matched frames
 maximum_inter_match_search = 24 # how many frames to calculate hamming distance for in a batch
+maximum_near_candidates = 64 # when finding near matches, ignore parts of hashes shared by more than this many frames
+maximum_frames_per_process = 8 # how many stills to grab in a single ffmpeg process, each of which opens the movie
 
 
 def main():
-    db_path = "data/frame_hashes.db"
-
-    label_a = "theatrical"
-    table_a_name = "two_towers_theatrical"
-    movie_a_filename = "C:\\Users\\obroo\\Lord of the Rings\\The Lord of the Rings The Two Towers (2002) Theatrical Remux-2160p HDR.mkv"
+    parser = argparse.ArgumentParser(
+        prog='Compare Hashes',
+        description='Compares the frame hashes of two or more editions, and reports the ranges in which they differ'
+    )
+
+    parser.add_argument('--db', default="data/frame_hashes.db", help="Path to database file")
+    parser.add_argument('--edition', action="append", nargs=3, metavar=("LABEL", "TABLE", "MOVIE"),
+                        help="An edition to compare, given once for each edition")
+    parser.add_argument('--reference', help="Label of the edition to compare every other edition with, "
+                                            "rather than comparing every pair of editions")
+    parser.add_argument('--engine', choices=list(matching_engines),
+                        help="Find unique matches with a query in SQLite, or with NumPy over hashes loaded in memory, "
+                             "which finds each edition's unique hashes once for every pair it's in. Defaults to sql "
+                             "for two editions, and numpy for more")
+    parser.add_argument('--workers', default=1, type=int, help="Number of processes to match the gaps with")
+    parser.add_argument('--cut-workers', default=4, type=int,
+                        help="Number of ffmpeg processes to trim clips and grab stills with at once")
+    parser.add_argument('--anchors', default="unique", choices=["unique", "fuzzy", "fused"],
+                        help="Match only identical hashes, also hashes within the perceptual match threshold, "
+                             "or identical hashes of any of the hash columns")
+    parser.add_argument('--alignment', default="ordered", choices=["ordered", "scenes"],
+                        help="Assume scenes are in the same order in both editions, or also find scenes that moved")
+    parser.add_argument('--metrics', help="Path to write timings and counters for each stage to, "
+                                          "as a Prometheus textfile if it ends in .prom, or otherwise as JSON")
+    parser.add_argument('--profile', help="Path to write cProfile stats for the run to")
+    args = parser.parse_args()
+
+    db_path = args.db
+
+    if args.edition:
+        editions = [Edition(label, table_name, movie_filename) for label, table_name, movie_filename in args.edition]
+    else:
+        editions = [
+            Edition("theatrical", "two_towers_theatrical",
+                    "C:\\Users\\obroo\\Lord of the Rings\\The Lord of the Rings The Two Towers (2002) Theatrical Remux-2160p HDR.mkv"),
+            Edition("extended", "two_towers_extended",
+                    "C:\\Users\\obroo\\Lord of the Rings\\The Lord of the Rings The Two Towers (2002) Extended Remux-2160p HDR.mkv"),
+        ]
 
-    label_b = "extended"
-    table_b_name = "two_towers_extended"
-    movie_b_filename = "C:\\Users\\obroo\\Lord of the Rings\\The Lord of the Rings The Two Towers (2002) Extended Remux-2160p HDR.mkv"
+    labels = [x.label for x in editions]
+    if len(editions) < 2:
+        parser.error("At least two editions are needed to compare")
+    if len(set(labels)) < len(labels):
+        parser.error("Every edition needs a different label")
+    if args.reference is not None and args.reference not in labels:
+        parser.error(f"No edition is labelled {args.reference}")
+    reference = next((x for x in editions if x.label == args.reference), None)
+    # the sql engine finds the unique hashes of both editions again for every pair
+    engine = args.engine or ("sql" if len(editions) == 2 else "numpy")
 
     print_json = False
     trim_videos = True
     grab_frames = True
     video_padding_seconds = 5
 
-    matches = read_unique_valid_matches(db_path, table_a_name, table_b_name)
-
-    table = []
-    print()
-    with Bar('Matching', max=len(matches)) as bar:
-        for index in range(len(matches) - 1):
-            matched = match(db_path, table_a_name, table_b_name, matches[index + 1], matches[index])
-            if matched: table.append(matched)
-            bar.next()
-
-    def hash_difference_sort_key(difference: HashDifference) -> timedelta:
-        return max(difference.a_range.range, difference.b_range.range)
-
-    sorted_table = sorted(table, key=hash_difference_sort_key)
-
-    tabulated = tabulate(
-        [(
-            x.a_range.start, x.a_range.end, x.a_range.type,
-            x.b_range.start, x.b_range.end, x.b_range.type,
-            x.a_range.range, x.b_range.range, x.range_difference
-        ) for x in sorted_table],
-        headers=["A Start", "A End", "A Type", "B Start", "B End", "B Type", "A Range", "B Range", "Range Difference"],
-        tablefmt="github")
-
-    print()
-    print(f'Count ({len(sorted_table)}):')
-    print()
-    print(tabulated)
-
-    if print_json:
-        a_differences = [
-            get_differences_dict(a_range)
-            for a_range in [x.a_range for x in table]
-            if a_range.range > timedelta(seconds=0)
-        ]
-        print(json.dumps(a_differences))
-
-        b_differences = [
-            get_differences_dict(b_range)
-            for b_range in [x.b_range for x in table]
-            if b_range.range > timedelta(seconds=0)
-        ]
-        print(json.dumps(b_differences))
+    with instrument(args.metrics, args.profile):
+        # each edition's hashes, unique hashes and index are loaded once and shared by every comparison it's part of
+        table = []
+        for a, b in get_edition_pairs(editions, reference):
+            print()
+            print(f"{a.label} and {b.label}:")
+            differences = compare_editions(db_path, a, b, engine, args.anchors, args.alignment, args.workers)
+            table.extend(EditionDifference(a, b, x) for x in differences)
+            metrics.count("differences", len(differences))
+
+        def hash_difference_sort_key(row: EditionDifference) -> timedelta:
+            return max(row.difference.a_range.range, row.difference.b_range.range)
+
+        sorted_table = sorted(table, key=hash_difference_sort_key)
+
+        tabulated = tabulate(
+            [(
+                x.a.label, x.difference.a_range.start, x.difference.a_range.end, x.difference.a_range.type,
+                x.b.label, x.difference.b_range.start, x.difference.b_range.end, x.difference.b_range.type,
+                x.difference.a_range.range, x.difference.b_range.range, x.difference.range_difference
+            ) for x in sorted_table],
+            headers=["A", "A Start", "A End", "A Type", "B", "B Start", "B End", "B Type",
+                     "A Range", "B Range", "Range Difference"],
+            tablefmt="github")
 
-    if trim_videos or grab_frames:
         print()
-        with Bar('Cutting', max=len(sorted_table)) as bar:
-            video_padding = timedelta(seconds=video_padding_seconds)
-            for (index, row) in enumerate(sorted_table):
-
-                a_start_time = row.a_range.start
-                a_end_time = row.a_range.end
-                a_range = row.a_range.range
-                b_start_time = row.b_range.start
-                b_end_time = row.b_range.end
-
-                if trim_videos:
-                    trim_video(movie_a_filename, label_a, index, a_start_time - video_padding, a_start_time)
-                    trim_video(movie_a_filename, label_a, index, a_end_time - a_range, a_end_time + video_padding)
-                    trim_video(movie_b_filename, label_b, index, b_start_time - video_padding, b_end_time + video_padding)
-
-                if grab_frames:
-                    grab_frame(movie_a_filename, label_a, index, a_start_time)
-                    grab_frame(movie_b_filename, label_b, index, b_start_time)
-                    grab_frame(movie_a_filename, label_a, index, a_end_time)
-                    grab_frame(movie_b_filename, label_b, index, b_end_time)
-
-                bar.next()
+        print(f'Count ({len(sorted_table)}):')
+        print()
+        print(tabulated)
+
+        if print_json:
+            for a, b in get_edition_pairs(editions, reference):
+                a_differences = [
+                    get_differences_dict(a_range)
+                    for a_range in [x.difference.a_range for x in table if x.a is a and x.b is b]
+                    if a_range.range > timedelta(seconds=0)
+                ]
+                print(json.dumps(a_differences))
+
+                b_differences = [
+                    get_differences_dict(b_range)
+                    for b_range in [x.difference.b_range for x in table if x.a is a and x.b is b]
+                    if b_range.range > timedelta(seconds=0)
+                ]
+                print(json.dumps(b_differences))
+
+        if trim_videos or grab_frames:
+            print()
+            with metrics.timer("cut_seconds"):
+                cut_differences(sorted_table, trim_videos, grab_frames, timedelta(seconds=video_padding_seconds),
+                                args.cut_workers)
 
 
 if __name__ == "__main__":
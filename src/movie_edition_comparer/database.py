@@ -0,0 +1,203 @@
+import os
+import sqlite3
+from contextlib import closing
+
+from algorithms import HashAlgorithm, hashing_algorithms, get_column_name
+
+
+def create_database(db_path: str, table_name: str):
+    db_dir = os.path.dirname(db_path)
+    os.makedirs(db_dir, exist_ok=True)
+    with closing(sqlite3.connect(db_path)) as connection:
+        create_table(connection, table_name)
+        create_indexes(connection, table_name)
+
+
+def get_cache_dir(db_path: str) -> str:
+    # each database has its own directory, as tables of the same name in databases beside each other are unrelated
+    name, _ = os.path.splitext(os.path.basename(db_path))
+    return os.path.join(os.path.dirname(db_path), "cache", name)
+
+
+def create_table(connection: sqlite3.Connection, table_name: str, column_names: list[str] | None = None):
+    if column_names is None:
+        column_names = [get_column_name(x) for x in hashing_algorithms]
+    columns = ",\n            ".join(f"{x} BLOB NOT NULL" for x in column_names)
+    connection.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            frame_index INTEGER NOT NULL PRIMARY KEY,
+            {columns}
+        )
+    """)
+
+
+def bump_table_version(connection: sqlite3.Connection, table_name: str):
+    # lets caches built from a table notice that it has been written to since
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS table_versions (
+            table_name TEXT NOT NULL PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+    """)
+    connection.execute("""
+        INSERT INTO table_versions (table_name, version)
+        VALUES (?, 1)
+        ON CONFLICT (table_name) DO UPDATE SET version = version + 1
+    """, (table_name,))
+
+
+def read_table_signature(connection: sqlite3.Connection, table_name: str, column_name: str) -> str:
+    has_versions = connection.execute("""
+        SELECT count(1) FROM sqlite_master WHERE type = 'table' AND name = 'table_versions'
+    """).fetchone()[0]
+    version = connection.execute("""
+        SELECT version FROM table_versions WHERE table_name = ?
+    """, (table_name,)).fetchone() if has_versions else None
+    count, hashed_count, max_index = connection.execute(f"""
+        SELECT count(1), count({column_name}), max(frame_index) FROM {table_name}
+    """).fetchone()
+    return f"{version[0] if version else 0}-{count}-{hashed_count}-{max_index}"
+
+
+def create_indexes(connection: sqlite3.Connection, table_name: str):
+    for column_name in get_hash_column_types(connection, table_name):
+        connection.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_{column_name} ON {table_name} ({column_name})")
+
+
+def get_hash_column_types(connection: sqlite3.Connection, table_name: str) -> dict[str, str]:
+    rows = connection.execute(f"PRAGMA table_info({table_name})").fetchall()
+    return {name: column_type.upper() for _, name, column_type, *_ in rows if name.startswith("hash_")}
+
+
+def is_hex_table(connection: sqlite3.Connection, table_name: str) -> bool:
+    # tables hashed before hashes were stored as raw bytes hold hex strings in TEXT columns
+    return "TEXT" in get_hash_column_types(connection, table_name).values()
+
+
+def register_functions(connection: sqlite3.Connection):
+    connection.create_function("hex_to_blob", 1, lambda x: None if x is None else bytes.fromhex(x),
+                               deterministic=True)
+
+
+def get_comparable_columns(connection: sqlite3.Connection,
+                           table_a_name: str, table_b_name: str, column_name: str) -> tuple[str, str]:
+    a_column = f"{table_a_name}.{column_name}"
+    b_column = f"{table_b_name}.{column_name}"
+
+    # hex and raw byte hashes never compare equal, so convert the hex side when only one table has been migrated
+    a_hex = is_hex_table(connection, table_a_name)
+    if a_hex != is_hex_table(connection, table_b_name):
+        register_functions(connection)
+        if a_hex:
+            a_column = f"hex_to_blob({a_column})"
+        else:
+            b_column = f"hex_to_blob({b_column})"
+
+    return a_column, b_column
+
+
+def configure_bulk_load(connection: sqlite3.Connection, cache_size: int = 256):
+    # a crash can lose the last transaction but never corrupts the database, which only costs rehashing those frames
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    connection.execute(f"PRAGMA cache_size = {-cache_size * 1024}")
+    connection.execute("PRAGMA temp_store = MEMORY")
+
+
+def drop_indexes(connection: sqlite3.Connection, table_name: str):
+    for column_name in get_hash_column_types(connection, table_name):
+        connection.execute(f"DROP INDEX IF EXISTS idx_{table_name}_{column_name}")
+
+
+def add_missing_columns(connection: sqlite3.Connection, table_name: str) -> list[HashAlgorithm]:
+    # existing rows have no value for a new column, so it can't be NOT NULL until every row has been rehashed
+    column_types = get_hash_column_types(connection, table_name)
+    missing = [x for x in hashing_algorithms if get_column_name(x) not in column_types]
+    for algorithm in missing:
+        connection.execute(f"ALTER TABLE {table_name} ADD COLUMN {get_column_name(algorithm)} BLOB")
+    connection.commit()
+    return missing
+
+
+def read_frame_indexes(connection: sqlite3.Connection, table_name: str) -> set[int]:
+    rows = connection.execute(f"SELECT frame_index FROM {table_name}").fetchall()
+    return {frame_index for frame_index, in rows}
+
+
+def read_missing_hashes(connection: sqlite3.Connection, table_name: str) -> dict[int, tuple[HashAlgorithm, ...]]:
+    algorithms = [x for x in hashing_algorithms if get_column_name(x) in get_hash_column_types(connection, table_name)]
+    is_nulls = [f"{get_column_name(x)} IS NULL" for x in algorithms]
+    rows = connection.execute(f"""
+        SELECT frame_index, {", ".join(is_nulls)}
+        FROM {table_name}
+        WHERE {" OR ".join(is_nulls)}
+    """).fetchall()
+    return {frame_index: tuple(x for x, is_null in zip(algorithms, is_nulls) if is_null)
+            for frame_index, *is_nulls in rows}
+
+
+class HashWriter:
+    """
+    Buffers frame hashes and writes them in batches with executemany, committing whenever at least checkpoint_size
+    rows have been written since the last commit, so an interrupted run keeps most of its work.
+    """
+
+    def __init__(self, connection: sqlite3.Connection, table_name: str, batch_size: int = 4096,
+                 checkpoint_size: int = 16384):
+        self.connection = connection
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.checkpoint_size = checkpoint_size
+        self.rows: dict[tuple[bool, tuple[HashAlgorithm, ...]], list[list]] = {}
+        self.pending = 0
+        self.uncommitted = 0
+        self.count = 0
+
+    def add(self, index: int, hashes: dict[HashAlgorithm, bytes]):
+        self.rows.setdefault((False, tuple(hashes)), []).append([index, *hashes.values()])
+        self.next()
+
+    def update(self, index: int, hashes: dict[HashAlgorithm, bytes]):
+        self.rows.setdefault((True, tuple(hashes)), []).append([*hashes.values(), index])
+        self.next()
+
+    def next(self):
+        self.pending += 1
+        self.count += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for (update, algorithms), rows in self.rows.items():
+            column_names = [get_column_name(x) for x in algorithms]
+            if update:
+                assignments = ", ".join(f"{x} = ?" for x in column_names)
+                self.connection.executemany(f"""
+                    UPDATE {self.table_name}
+                    SET {assignments}
+                    WHERE frame_index = ?
+                """, rows)
+            else:
+                values_names = ", ".join("?" for _ in range(len(column_names) + 1))
+                self.connection.executemany(f"""
+                    INSERT INTO {self.table_name} (frame_index, {", ".join(column_names)})
+                    VALUES ({values_names})
+                """, rows)
+        self.rows.clear()
+
+        self.uncommitted += self.pending
+        self.pending = 0
+        if self.uncommitted >= self.checkpoint_size:
+            self.commit()
+
+    def commit(self):
+        bump_table_version(self.connection, self.table_name)
+        self.connection.commit()
+        self.uncommitted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+        self.commit()
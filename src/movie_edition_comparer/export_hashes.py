@@ -0,0 +1,45 @@
+import argparse
+import sqlite3
+from contextlib import closing
+
+from progress.bar import Bar
+
+from compare_hashes import read_edition_hashes
+from database import get_hash_column_types
+
+
+def read_hash_tables(connection: sqlite3.Connection) -> list[str]:
+    rows = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+    return [name for name, in rows if get_hash_column_types(connection, name)]
+
+
+def export_hashes(db_path: str, table_names: list[str]):
+    with closing(sqlite3.connect(db_path)) as connection:
+        if not table_names:
+            table_names = read_hash_tables(connection)
+        columns = [(table_name, column_name)
+                   for table_name in table_names
+                   for column_name in get_hash_column_types(connection, table_name)]
+
+    # reading an edition exports it, unless its files are already up to date with its table
+    with Bar('Exporting', max=len(columns)) as bar:
+        for table_name, column_name in columns:
+            read_edition_hashes(db_path, table_name, column_name)
+            bar.next()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Export Hashes',
+        description='Exports the hash columns of frame hash tables to files which comparisons memory map'
+    )
+
+    parser.add_argument('tables', nargs='*', help="Names of the tables to export, defaults to every frame hash table")
+    parser.add_argument('--db', default="data/frame_hashes.db", help="Path to database file")
+    args = parser.parse_args()
+
+    export_hashes(args.db, args.tables)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import os
+from typing import IO
+
+import numpy as np
+from numpy import ndarray
+
+from algorithms import hamming_distances
+
+
+def get_chunk_keys(hashes: ndarray, start: int, end: int) -> ndarray:
+    # each chunk of a hash viewed as a single opaque value, so chunks can be sorted and searched as a whole
+    return np.ascontiguousarray(hashes[:, start:end]).view(np.dtype((np.void, end - start))).ravel()
+
+
+def expand_ranges(lower: ndarray, upper: ndarray) -> tuple[ndarray, ndarray]:
+    # for every range, repeats its position once per value in the range, alongside each of those values
+    counts = upper - lower
+    positions = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return positions, lower[positions] + offsets
+
+
+class HammingIndex:
+    """
+    A multi-index hashing index over packed hashes, for finding every hash within a Hamming distance of another.
+
+    Each hash is split into `chunks` byte ranges. Two hashes differing in fewer than `chunks` bits must have at least
+    one chunk in which they are identical, so the candidates for a query are found with a binary search for each of
+    its chunks in a sorted copy of that chunk, and only those candidates have their full distance calculated.
+    """
+
+    def __init__(self, hashes: ndarray, chunks: int, sorted_keys: list[ndarray] | None = None,
+                 orders: list[ndarray] | None = None):
+        if not 0 < chunks <= hashes.shape[1]:
+            raise ValueError(f"Can't split {hashes.shape[1]} byte hashes into {chunks} chunks")
+
+        self.hashes = hashes
+        self.chunks = chunks
+        self.bounds = np.linspace(0, hashes.shape[1], chunks + 1).astype(int)
+
+        if sorted_keys is None or orders is None:
+            orders = [np.argsort(get_chunk_keys(hashes, start, end), kind="stable")
+                      for start, end in zip(self.bounds, self.bounds[1:])]
+            sorted_keys = [get_chunk_keys(hashes[order], start, end)
+                           for order, start, end in zip(orders, self.bounds, self.bounds[1:])]
+        self.sorted_keys = sorted_keys
+        self.orders = orders
+
+    def check_distance(self, max_distance: int):
+        if max_distance >= self.chunks:
+            raise ValueError(f"An index of {self.chunks} chunks can only find hashes within {self.chunks - 1} bits")
+
+    def query(self, query_hash: ndarray, max_distance: int) -> ndarray:
+        """
+        Finds the rows of every hash within max_distance bits of the query hash.
+        """
+        self.check_distance(max_distance)
+
+        candidates = []
+        for sorted_keys, order, start, end in zip(self.sorted_keys, self.orders, self.bounds, self.bounds[1:]):
+            key = get_chunk_keys(query_hash.reshape(1, -1), start, end)
+            lower = np.searchsorted(sorted_keys, key, side="left")[0]
+            upper = np.searchsorted(sorted_keys, key, side="right")[0]
+            candidates.append(order[lower:upper])
+
+        candidates = np.unique(np.concatenate(candidates))
+        return candidates[hamming_distances(query_hash, self.hashes[candidates]) <= max_distance]
+
+    def query_all(self, query_hashes: ndarray, max_distance: int,
+                  max_candidates: int | None = None) -> tuple[ndarray, ndarray, ndarray]:
+        """
+        Finds every pair of a query hash and an indexed hash within max_distance bits of each other, returned as the
+        rows of the query hashes and the rows of the indexed hashes, along with which query hashes had a chunk skipped.
+        A chunk shared by more than max_candidates indexed hashes, such as the chunks of a black frame, is skipped, so
+        those queries, and the indexed hashes returned by find_common, may be missing neighbours.
+        """
+        self.check_distance(max_distance)
+
+        query_rows = []
+        index_rows = []
+        skipped = np.zeros(len(query_hashes), dtype=bool)
+        for sorted_keys, order, start, end in zip(self.sorted_keys, self.orders, self.bounds, self.bounds[1:]):
+            keys = get_chunk_keys(query_hashes, start, end)
+            lower = np.searchsorted(sorted_keys, keys, side="left")
+            upper = np.searchsorted(sorted_keys, keys, side="right")
+            if max_candidates is not None:
+                skipped |= upper - lower > max_candidates
+                upper = np.where(upper - lower > max_candidates, lower, upper)
+
+            positions, sorted_rows = expand_ranges(lower, upper)
+            query_rows.append(positions)
+            index_rows.append(order[sorted_rows])
+
+        # a pair sharing several chunks is found once per chunk
+        pairs = np.unique(np.stack([np.concatenate(query_rows), np.concatenate(index_rows)]), axis=1)
+        query_rows, index_rows = pairs
+        within = hamming_distances(query_hashes[query_rows], self.hashes[index_rows]) <= max_distance
+        return query_rows[within], index_rows[within], skipped
+
+    def find_common(self, max_candidates: int) -> ndarray:
+        """
+        Finds which indexed hashes have a chunk shared by more than max_candidates indexed hashes, which query_all skips.
+        """
+        common = np.zeros(len(self.hashes), dtype=bool)
+        for sorted_keys, order in zip(self.sorted_keys, self.orders):
+            counts = np.searchsorted(sorted_keys, sorted_keys, side="right") \
+                - np.searchsorted(sorted_keys, sorted_keys, side="left")
+            common[order[counts > max_candidates]] = True
+        return common
+
+    def save(self, file: IO, signature: str):
+        np.savez(file, signature=signature, chunks=self.chunks, hashes=self.hashes, orders=np.stack(self.orders),
+                 **{f"sorted_keys_{i}": x for i, x in enumerate(self.sorted_keys)})
+
+    @staticmethod
+    def load(path: str, signature: str) -> "HammingIndex | None":
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as data:
+            if str(data["signature"]) != signature:
+                return None
+            chunks = int(data["chunks"])
+            return HammingIndex(data["hashes"], chunks,
+                                [data[f"sorted_keys_{i}"] for i in range(chunks)], list(data["orders"]))
@@ -1,70 +1,366 @@
 import argparse
-import concurrent
-import os
+import bisect
 import sqlite3
-from concurrent.futures import ThreadPoolExecutor
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import closing
 from datetime import datetime
+from multiprocessing.shared_memory import SharedMemory
 
 import cv2
+import numpy as np
 from numpy import ndarray
 from progress.bar import Bar
 
-from algorithms import hashing_algorithms, get_column_name
+from algorithms import FramePlanes, HashAlgorithm, get_column_name, hashing_algorithms
+from database import HashWriter, add_missing_columns, configure_bulk_load, create_database, create_indexes, \
+    drop_indexes, is_hex_table, read_frame_indexes, read_missing_hashes
+from metrics import instrument, metrics
 
+all_algorithms = tuple(hashing_algorithms)
+maximum_grab_skip = 250 # how many frames to decode through, rather than seek over, when skipping frames that aren't hashed
 
-def create_database(db_path: str, table_name: str):
-    column_names = [get_column_name(x) for x in hashing_algorithms]
-    db_dir = os.path.dirname(db_path)
-    os.makedirs(db_dir, exist_ok=True)
-    with closing(sqlite3.connect(db_path)) as connection:
-        connection.execute(f"CREATE TABLE IF NOT EXISTS {table_name} (\n"
-                           f"    frame_index INTEGER NOT NULL PRIMARY KEY,\n"
-                           f"    {",\n\t".join([f"{x} TEXT NOT NULL" for x in column_names])}\n"
-                           f")")
-        for column_name in column_names:
-            connection.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_{column_name} ON {table_name} ({column_name})")
 
+def get_frame_hashes(index: int, frame: ndarray, algorithms: tuple[HashAlgorithm, ...] = all_algorithms):
+    planes = FramePlanes(frame)
+    return index, {x: hashing_algorithms[x](planes) for x in algorithms}
 
-def get_frame_hashes(index: int, frame: ndarray):
-    return index, {name: func(frame) for name, func in hashing_algorithms.items()}
 
+def get_timed_frame_hashes(index: int, frame: ndarray, algorithms: tuple[HashAlgorithm, ...] = all_algorithms):
+    # the planes are shared between algorithms, so each plane is timed as part of the first algorithm to use it
+    planes = FramePlanes(frame)
+    hashes = {}
+    seconds = {}
+    for algorithm in algorithms:
+        start = time.perf_counter()
+        hashes[algorithm] = hashing_algorithms[algorithm](planes)
+        seconds[algorithm] = time.perf_counter() - start
+    return index, hashes, seconds
 
-def hash_video_frames_to_db(video_path: str, db_path: str, table_name: str, workers: int):
+
+attached_frames: dict[str, SharedMemory] = {}
+
+
+def get_shared_frame_hashes(index: int, name: str, shape: tuple[int, ...], dtype: str,
+                            algorithms: tuple[HashAlgorithm, ...] = all_algorithms, timed: bool = False):
+    # runs in a worker process, which keeps each shared memory slot attached for the lifetime of the process
+    if name not in attached_frames:
+        attached_frames[name] = SharedMemory(name=name)
+    frame = np.ndarray(shape, dtype=dtype, buffer=attached_frames[name].buf)
+    return (get_timed_frame_hashes if timed else get_frame_hashes)(index, frame, algorithms)
+
+
+class SharedFrames:
+    """
+    A ring of shared memory slots for passing decoded frames to worker processes without pickling them. The nth frame
+    put is written to slot n % slots, so there must never be more than `slots` frames in flight. Slots are taken in
+    the order frames are put rather than by frame index, as skipped frames leave gaps between the indexes in flight.
+    """
+
+    def __init__(self, slots: int, frame: ndarray):
+        self.shape = frame.shape
+        self.dtype = frame.dtype.str
+        self.memory = [SharedMemory(create=True, size=frame.nbytes) for _ in range(slots)]
+        self.put_count = 0
+
+    def put(self, index: int, frame: ndarray) -> tuple[int, str, tuple[int, ...], str]:
+        memory = self.memory[self.put_count % len(self.memory)]
+        self.put_count += 1
+        np.ndarray(self.shape, dtype=self.dtype, buffer=memory.buf)[:] = frame
+        return index, memory.name, self.shape, self.dtype
+
+    def close(self):
+        for memory in self.memory:
+            memory.close()
+            memory.unlink()
+
+
+def create_executor(backend: str, workers: int) -> Executor:
+    if backend == "process":
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+def get_max_in_flight(frame: ndarray, max_memory: int) -> int:
+    # frames waiting to be hashed are held in memory until their hashes are written, so cap how many may be queued
+    return max(1, max_memory * 1024 * 1024 // frame.nbytes)
+
+
+def seek_to_frame(cap: cv2.VideoCapture, frame_index: int):
+    if frame_index == 0:
+        return
+
+    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+    if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) != frame_index:
+        # the container can't seek to an exact frame, so decode every frame up to it instead
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        for _ in range(frame_index):
+            cap.grab()
+
+
+def skip_to_frame(cap: cv2.VideoCapture, position: int, frame_index: int):
+    # seeking decodes from the keyframe before the frame anyway, so short skips are quicker to decode through
+    if frame_index - position > maximum_grab_skip:
+        seek_to_frame(cap, frame_index)
+    else:
+        for _ in range(frame_index - position):
+            cap.grab()
+
+
+def merge_ranges(ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class FrameSelection:
+    """
+    The frames to hash, which are every step-th frame, or runs of run_length consecutive frames starting at every
+    step-th frame, and, if any ranges are given, only those within the ranges. Each range is of the frames from its
+    start up to but excluding its end.
+    """
+
+    def __init__(self, step: int = 1, ranges: list[tuple[int, int]] | None = None, run_length: int = 1):
+        if step < 1:
+            raise ValueError(f"Can't hash every {step}th frame")
+        if not 1 <= run_length <= step:
+            raise ValueError(f"Can't hash runs of {run_length} frames every {step} frames")
+        self.step = step
+        self.run_length = run_length
+        self.ranges = merge_ranges(ranges) if ranges is not None else None
+        self.starts = [start for start, _ in self.ranges] if self.ranges is not None else None
+
+    def __contains__(self, frame_index: int) -> bool:
+        if frame_index % self.step >= self.run_length:
+            return False
+        if self.ranges is None:
+            return True
+        position = bisect.bisect_right(self.starts, frame_index) - 1
+        return position >= 0 and frame_index < self.ranges[position][1]
+
+
+class HashedFrames:
+    """
+    The frames already in a table, so a resumed run only hashes frames without a row, and an incremental run also
+    hashes the algorithms with no value in existing rows. Frames outside the selection are never hashed.
+    """
+
+    def __init__(self, connection: sqlite3.Connection, table_name: str, resume: bool, incremental: bool,
+                 selection: FrameSelection):
+        if is_hex_table(connection, table_name):
+            # new hashes are raw bytes, which can't be compared with the hex strings already in the table
+            raise ValueError(f"Table {table_name} holds hashes as hex strings, run mec-migrate on it first")
+        self.selection = selection
+        self.existing = read_frame_indexes(connection, table_name) if resume or incremental else set()
+        self.missing = {}
+        if incremental:
+            add_missing_columns(connection, table_name)
+            self.missing = read_missing_hashes(connection, table_name)
+
+    def get_missing_algorithms(self, frame_index: int) -> tuple[HashAlgorithm, ...]:
+        if frame_index not in self.selection:
+            return ()
+        if frame_index not in self.existing:
+            return all_algorithms
+        return self.missing.get(frame_index, ())
+
+    def get_first_missing_frame(self, frame_count: int) -> int:
+        first_missing = min(self.missing, default=frame_count)
+        return next((x for x in range(first_missing) if x not in self.existing), first_missing)
+
+    def write(self, writer: HashWriter, index: int, hashes: dict[HashAlgorithm, bytes]):
+        if index in self.existing:
+            writer.update(index, hashes)
+        else:
+            writer.add(index, hashes)
+
+
+def write_frame_hashes(hashed_frames: HashedFrames, writer: HashWriter, index: int,
+                       hashes: dict[HashAlgorithm, bytes], seconds: dict[HashAlgorithm, float] | None = None):
+    # hashes are only timed when metrics are enabled
+    if seconds:
+        for algorithm, x in seconds.items():
+            metrics.observe(f"{get_column_name(algorithm)}_seconds", x)
+    with metrics.timer("write_seconds"):
+        hashed_frames.write(writer, index, hashes)
+
+
+def can_seek_exactly(video_path: str, frame_index: int) -> bool:
+    cap = cv2.VideoCapture(video_path)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+    exact = int(cap.get(cv2.CAP_PROP_POS_FRAMES)) == frame_index
+    cap.release()
+    return exact
+
+
+def hash_video_segment(video_path: str, frames: list[tuple[int, tuple[HashAlgorithm, ...]]], timed: bool = False):
+    # runs on a worker, with its own reader, so segments are decoded in parallel rather than by a single reader
     cap = cv2.VideoCapture(video_path)
+    get_hashes = get_timed_frame_hashes if timed else get_frame_hashes
+    position = frames[0][0]
+    seek_to_frame(cap, position)
+    results = []
+    decode_seconds = 0
+    for frame_index, algorithms in frames:
+        start = time.perf_counter()
+        skip_to_frame(cap, position, frame_index)
+        ret, frame = cap.read()
+        decode_seconds += time.perf_counter() - start
+        if not ret:
+            break
+        position = frame_index + 1
+        results.append(get_hashes(frame_index, frame, algorithms))
+    cap.release()
+    return results, decode_seconds
+
+
+def hash_segments(video_path: str, executor: Executor, hashed_frames: HashedFrames, writer: HashWriter,
+                  in_flight: deque, start_index: int, frame_count: int, segment_size: int, max_in_flight: int,
+                  bar: Bar):
+    """
+    Hashes the frames from start_index in segments of segment_size frames, each decoded and hashed on a worker with its
+    own reader, and writes the hashes of each segment in frame order.
+    """
+
+    def write_oldest():
+        results, decode_seconds = in_flight.popleft().result()
+        metrics.observe("decode_seconds", decode_seconds)
+        metrics.count("frames_decoded", len(results))
+        for result in results:
+            write_frame_hashes(hashed_frames, writer, *result)
+            bar.next()
+
+    for segment_start in range(start_index, frame_count, segment_size):
+        segment_end = min(segment_start + segment_size, frame_count)
+        frames = [(x, hashed_frames.get_missing_algorithms(x)) for x in range(segment_start, segment_end)]
+        frames = [(x, algorithms) for x, algorithms in frames if algorithms]
+        bar.next(segment_end - segment_start - len(frames))
+        if not frames:
+            continue
+
+        in_flight.append(executor.submit(hash_video_segment, video_path, frames, metrics.enabled))
+        metrics.observe("queue_depth", len(in_flight))
+        while in_flight and (len(in_flight) >= max_in_flight or in_flight[0].done()):
+            write_oldest()
+
+    while in_flight:
+        write_oldest()
+
+
+def hash_video_frames_to_db(video_path: str, db_path: str, table_name: str, workers: int, max_memory: int,
+                            backend: str = "thread", batch_size: int = 4096, defer_indexes: bool = True,
+                            checkpoint_size: int = 16384, resume: bool = False, incremental: bool = False,
+                            selection: FrameSelection | None = None, segment_size: int = 0) -> int:
+    cap = cv2.VideoCapture(video_path)
+    if selection is None:
+        selection = FrameSelection()
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    if segment_size and not can_seek_exactly(video_path, frame_count // 2):
+        # every segment would decode from the start of the video to reach its first frame
+        print("Can't seek to an exact frame, so decoding with a single reader instead of in segments")
+        segment_size = 0
 
     with (closing(sqlite3.connect(db_path)) as connection,
-          ThreadPoolExecutor(max_workers=workers) as executor):
+          create_executor(backend, workers) as executor):
 
-        futures = []
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        with Bar('Hashing', max=frame_count) as bar:
-            for frame_index in range(frame_count):
-                ret, frame = cap.read()
-                if not ret:
-                    break
+        configure_bulk_load(connection)
+        hashed_frames = HashedFrames(connection, table_name, resume, incremental, selection)
+        if defer_indexes:
+            # updating every index row by row is slower than building each one once the table is loaded
+            drop_indexes(connection, table_name)
 
-                future = executor.submit(get_frame_hashes, frame_index, frame)
-                futures.append(future)
-                bar.next()
+        writer = HashWriter(connection, table_name, batch_size, checkpoint_size)
+        in_flight = deque()
+        max_in_flight = None
+        shared_frames = None
+        start_index = hashed_frames.get_first_missing_frame(frame_count)
+        position = start_index
+        get_hashes = get_timed_frame_hashes if metrics.enabled else get_frame_hashes
+        try:
+            with (Bar('Hashing', max=frame_count - start_index) as bar,
+                  metrics.timer("hashing_seconds")):
+                if segment_size:
+                    # a worker decodes one frame of its segment at a time, and only returns the hashes, so two
+                    # segments per worker keep every worker busy without holding many frames in memory
+                    hash_segments(video_path, executor, hashed_frames, writer, in_flight, start_index, frame_count,
+                                  segment_size, workers * 2, bar)
+                else:
+                    seek_to_frame(cap, start_index)
+                    for frame_index in range(start_index, frame_count):
+                        algorithms = hashed_frames.get_missing_algorithms(frame_index)
+                        if not algorithms:
+                            # nothing to hash, so the frame is only decoded, or seeked over, on the way to the next
+                            # frame
+                            bar.next()
+                            continue
 
-        with Bar('Inserting', max=len(futures)) as bar:
-            for future in concurrent.futures.as_completed(futures):
-                index, hashes = future.result()
-                values = [index] + list(hashes.values())
+                        with metrics.timer("decode_seconds"):
+                            skip_to_frame(cap, position, frame_index)
+                            ret, frame = cap.read()
+                        if not ret:
+                            break
+                        position = frame_index + 1
+                        metrics.count("frames_decoded")
 
-                column_names = f"frame_index, {", ".join(get_column_name(x) for x in hashes.keys())}"
-                values_names = ", ".join(["?" for _ in values])
+                        if max_in_flight is None:
+                            max_in_flight = get_max_in_flight(frame, max_memory)
+                            if backend == "process":
+                                shared_frames = SharedFrames(max_in_flight, frame)
 
-                connection.execute(f"""
-                    INSERT INTO {table_name} ({column_names})
-                    VALUES ({values_names})
-                """, values)
-                bar.next()
+                        if shared_frames:
+                            future = executor.submit(get_shared_frame_hashes, *shared_frames.put(frame_index, frame),
+                                                     algorithms, metrics.enabled)
+                        else:
+                            future = executor.submit(get_hashes, frame_index, frame, algorithms)
+                        in_flight.append(future)
+                        metrics.observe("queue_depth", len(in_flight))
 
-        connection.commit()
+                        # write finished hashes in frame order, blocking on the oldest frame once the queue is full
+                        while in_flight and (len(in_flight) >= max_in_flight or in_flight[0].done()):
+                            write_frame_hashes(hashed_frames, writer, *in_flight.popleft().result())
+                            bar.next()
+
+                    while in_flight:
+                        write_frame_hashes(hashed_frames, writer, *in_flight.popleft().result())
+                        bar.next()
+        finally:
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown()
+            if shared_frames:
+                shared_frames.close()
+            try:
+                # keep every frame hashed so far, so an interrupted run can be resumed
+                with metrics.timer("write_seconds"):
+                    writer.flush()
+                    writer.commit()
+            finally:
+                # rebuilt even when the run fails, as dropping them was committed, and also indexes any columns added
+                # by an incremental run
+                with Bar('Indexing', max=1) as bar, metrics.timer("index_seconds"):
+                    create_indexes(connection, table_name)
+                    bar.next()
+                connection.commit()
 
     cap.release()
+    metrics.count("rows_written", writer.count)
+    metrics.set_rate("frames_per_second", "rows_written", "hashing_seconds")
+    metrics.set_rate("decoded_frames_per_second", "frames_decoded", "decode_seconds")
+    metrics.set_rate("rows_per_second", "rows_written", "write_seconds")
+    return writer.count
+
+
+def parse_range(value: str) -> tuple[int, int]:
+    start, _, end = value.partition("-")
+    try:
+        return int(start), int(end)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a range of frames, such as 1000-2000")
 
 
 def main():
@@ -76,15 +372,44 @@ def main():
     parser.add_argument('video', help="Path to the video file")
     parser.add_argument('table', help="Name of the table to save data to")
     parser.add_argument('--db', default="data/frame_hashes.db", help="Path to database file")
-    parser.add_argument('--threads', default=4, type=int, help="Number of threads to use")
+    parser.add_argument('--threads', default=4, type=int, help="Number of threads, or processes, to use")
+    parser.add_argument('--backend', default="thread", choices=["thread", "process"],
+                        help="Hash frames on a thread pool, or on a process pool fed through shared memory")
+    parser.add_argument('--batch-size', default=4096, type=int, help="Number of rows to insert at once")
+    parser.add_argument('--defer-indexes', default=True, action=argparse.BooleanOptionalAction,
+                        help="Drop the hash indexes while inserting, and rebuild them once all frames are hashed")
+    parser.add_argument('--checkpoint-size', default=16384, type=int,
+                        help="Number of rows to write between each commit")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue an interrupted run, hashing only frames missing from the table")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Also hash algorithms without a value for existing frames, such as newly added ones")
+    parser.add_argument('--max-memory', default=2048, type=int,
+                        help="Maximum memory in MB to use for frames waiting to be hashed")
+    parser.add_argument('--step', default=1, type=int,
+                        help="Hash only every nth frame, for a quick first comparison")
+    parser.add_argument('--ranges', nargs="+", type=parse_range, metavar="START-END",
+                        help="Hash only the frames from each start up to but excluding each end")
+    parser.add_argument('--segment-size', default=0, type=int,
+                        help="Decode the video in segments of this many frames, each with its own reader on a thread "
+                             "or process, rather than with a single reader")
+    parser.add_argument('--metrics', help="Path to write timings and counters for each stage to, "
+                                          "as a Prometheus textfile if it ends in .prom, or otherwise as JSON")
+    parser.add_argument('--profile', help="Path to write cProfile stats for the run to")
     args = parser.parse_args()
 
     start_time = datetime.now()
 
-    create_database(args.db, args.table)
-    hash_video_frames_to_db(args.video, args.db, args.table, args.threads)
+    with instrument(args.metrics, args.profile):
+        create_database(args.db, args.table)
+        frame_count = hash_video_frames_to_db(args.video, args.db, args.table, args.threads, args.max_memory,
+                                              args.backend, args.batch_size, args.defer_indexes,
+                                              args.checkpoint_size, args.resume, args.incremental,
+                                              FrameSelection(args.step, args.ranges), args.segment_size)
 
-    print(f"Took {datetime.now() - start_time}")
+    took = datetime.now() - start_time
+    print(f"Took {took}")
+    print(f"Hashed {frame_count} frames at {frame_count / max(took.total_seconds(), 1e-6):.2f} frames/sec")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,134 @@
+import cProfile
+import json
+import re
+import sqlite3
+import time
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+
+
+@dataclass
+class Summary:
+    count: int = 0
+    total: float = 0
+    maximum: float = 0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+
+
+class Metrics:
+    """
+    Timings, counters and values for each stage of a run. Until enabled, every method returns straight away, so stages
+    can be instrumented without slowing down runs that don't report them.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.summaries: dict[str, Summary] = {}
+        self.counters: dict[str, int] = {}
+        self.values: dict[str, float] = {}
+
+    def observe(self, name: str, value: float):
+        if self.enabled:
+            self.summaries.setdefault(name, Summary()).observe(value)
+
+    def count(self, name: str, amount: int = 1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name: str, value: float):
+        if self.enabled:
+            self.values[name] = value
+
+    def timer(self, name: str):
+        return self.time(name) if self.enabled else nullcontext()
+
+    @contextmanager
+    def time(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def get_total(self, name: str) -> float:
+        return self.summaries[name].total if name in self.summaries else 0
+
+    def set_rate(self, name: str, counter_name: str, seconds_name: str):
+        # such as frames per second, from a counter and the total of a timing
+        seconds = self.get_total(seconds_name)
+        if seconds > 0:
+            self.set(name, self.counters.get(counter_name, 0) / seconds)
+
+    def trace_queries(self, connection: sqlite3.Connection):
+        # counts every statement the connection runs
+        if self.enabled:
+            connection.set_trace_callback(lambda _: self.count("db_queries"))
+
+    def to_dict(self) -> dict:
+        return {
+            "summaries": {
+                name: {
+                    "count": x.count,
+                    "total": x.total,
+                    "mean": x.total / x.count if x.count else 0,
+                    "max": x.maximum,
+                } for name, x in self.summaries.items()
+            },
+            "counters": self.counters,
+            "values": self.values,
+        }
+
+    def to_prometheus(self, prefix: str = "mec") -> str:
+        lines = []
+        for name, x in self.summaries.items():
+            metric = get_metric_name(prefix, name)
+            lines += [f"# TYPE {metric} summary", f"{metric}_count {x.count}", f"{metric}_sum {x.total}",
+                      f"# TYPE {metric}_max gauge", f"{metric}_max {x.maximum}"]
+        for name, x in self.counters.items():
+            metric = get_metric_name(prefix, name)
+            lines += [f"# TYPE {metric}_total counter", f"{metric}_total {x}"]
+        for name, x in self.values.items():
+            metric = get_metric_name(prefix, name)
+            lines += [f"# TYPE {metric} gauge", f"{metric} {x}"]
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        # a Prometheus textfile for node exporter, or JSON for anything else
+        with open(path, "w") as file:
+            if path.endswith(".prom"):
+                file.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), file, indent=2)
+
+
+def get_metric_name(prefix: str, name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", f"{prefix}_{name}")
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def instrument(metrics_path: str | None, profile_path: str | None):
+    """
+    Enables metrics for the duration of a run and writes them to metrics_path, and profiles the run with cProfile and
+    writes the stats to profile_path, for whichever of them are given.
+    """
+    if metrics_path:
+        metrics.enabled = True
+    profiler = cProfile.Profile() if profile_path else None
+    if profiler:
+        profiler.enable()
+    try:
+        with metrics.timer("run_seconds"):
+            yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        if metrics_path:
+            metrics.write(metrics_path)
@@ -0,0 +1,68 @@
+import argparse
+import sqlite3
+from contextlib import closing
+
+from progress.bar import Bar
+
+from database import bump_table_version, create_indexes, create_table, get_hash_column_types, is_hex_table, \
+    register_functions
+
+
+def read_hex_tables(connection: sqlite3.Connection) -> list[str]:
+    rows = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+    return [name for name, in rows if is_hex_table(connection, name)]
+
+
+def migrate_table(connection: sqlite3.Connection, table_name: str):
+    column_types = get_hash_column_types(connection, table_name)
+    migrated_table_name = f"{table_name}_migrated"
+
+    create_table(connection, migrated_table_name, list(column_types))
+
+    values = ", ".join(f"hex_to_blob({x})" if column_type == "TEXT" else x for x, column_type in column_types.items())
+    connection.execute(f"""
+        INSERT INTO {migrated_table_name} (frame_index, {", ".join(column_types)})
+        SELECT frame_index, {values}
+        FROM {table_name}
+    """)
+
+    # dropping the original table also drops its indexes, which are recreated under the same names
+    connection.execute(f"DROP TABLE {table_name}")
+    connection.execute(f"ALTER TABLE {migrated_table_name} RENAME TO {table_name}")
+    create_indexes(connection, table_name)
+    bump_table_version(connection, table_name)
+
+
+def migrate_database(db_path: str, table_names: list[str]):
+    with closing(sqlite3.connect(db_path)) as connection:
+        register_functions(connection)
+
+        if not table_names:
+            table_names = read_hex_tables(connection)
+
+        with Bar('Migrating', max=len(table_names)) as bar:
+            for table_name in table_names:
+                if is_hex_table(connection, table_name):
+                    migrate_table(connection, table_name)
+                    connection.commit()
+                bar.next()
+
+        # reclaim the space freed by halving the size of every hash
+        connection.execute("VACUUM")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Migrate Database',
+        description='Converts frame hash tables from hex TEXT columns to raw byte BLOB columns'
+    )
+
+    parser.add_argument('tables', nargs='*', help="Names of the tables to migrate, defaults to every hex table")
+    parser.add_argument('--db', default="data/frame_hashes.db", help="Path to database file")
+    args = parser.parse_args()
+
+    migrate_database(args.db, args.tables)
+
+
+if __name__ == "__main__":
+    main()
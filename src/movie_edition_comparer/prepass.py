@@ -0,0 +1,126 @@
+import argparse
+import bisect
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from compare_hashes import HashMatch, create_hash_matches, find_fuzzy_matches, find_valid_matches, \
+    read_edition_hashes
+from database import create_database
+from hash_video import FrameSelection, hash_video_frames_to_db
+
+
+def get_frame_count(video_path: str) -> int:
+    cap = cv2.VideoCapture(video_path)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return frame_count
+
+
+def find_candidate_regions(matches: list[HashMatch], dropped: list[HashMatch], a_frame_count: int,
+                           b_frame_count: int) -> tuple[list[tuple[int, int]], list[tuple[int, int]]]:
+    """
+    Finds the regions of each edition which may hold a difference, from the matches between the sampled frames of both
+    editions. A difference changes the offset between the editions, so the frames between two consecutive matches are a
+    candidate region when their offsets differ. They're also a candidate when they hold a match dropped for going
+    backwards, as a moved scene may leave the same offset either side of it. The frames before the first match and
+    after the last are always candidates, as nothing sampled there shows whether they differ.
+    """
+    # the editions start together before their first frames, and end together after their last frames
+    a_indexes = [-1] + [x.a.index for x in matches] + [a_frame_count]
+    b_indexes = [-1] + [x.b.index for x in matches] + [b_frame_count]
+    moved = {bisect.bisect_left(a_indexes, x.a.index) - 1 for x in dropped} \
+        | {bisect.bisect_left(b_indexes, x.b.index) - 1 for x in dropped}
+
+    a_regions = []
+    b_regions = []
+    for index in range(len(a_indexes) - 1):
+        previous_a, current_a = a_indexes[index], a_indexes[index + 1]
+        previous_b, current_b = b_indexes[index], b_indexes[index + 1]
+        if previous_a + 1 == current_a and previous_b + 1 == current_b:
+            continue
+        if current_b - current_a != previous_b - previous_a or index in moved or index in (0, len(a_indexes) - 2):
+            a_regions.append((previous_a + 1, current_a))
+            b_regions.append((previous_b + 1, current_b))
+    return a_regions, b_regions
+
+
+def get_prepass_selections(step: int, burst_every: int) -> tuple[FrameSelection, FrameSelection]:
+    """
+    Gets the frames to sample from each edition. Were both sampled at every step-th frame, a difference whose length
+    isn't a multiple of the step would leave no sampled frame of one edition showing the same moment as a sampled frame
+    of the other until the next such difference. So the first edition is sampled at every step-th frame, and the second
+    in bursts of step consecutive frames, where each burst holds the same moment as one sampled frame of the first,
+    whatever the offset between them.
+    """
+    return FrameSelection(step), FrameSelection(step * burst_every, run_length=step)
+
+
+def run_prepass(video_a: str, table_a: str, video_b: str, table_b: str, db_path: str, step: int, burst_every: int,
+                workers: int, max_memory: int,
+                backend: str = "thread") -> tuple[list[tuple[int, int]], list[tuple[int, int]]]:
+    editions = [(video_a, table_a), (video_b, table_b)]
+
+    # frames already in a table are skipped, so a prepass can be rerun, or run on fully hashed tables
+    for (video_path, table_name), selection in zip(editions, get_prepass_selections(step, burst_every)):
+        create_database(db_path, table_name)
+        hash_video_frames_to_db(video_path, db_path, table_name, workers, max_memory, backend, resume=True,
+                                selection=selection)
+
+    # a different encode of the same frame is rarely pixel identical, so the editions are matched by near hashes
+    a = read_edition_hashes(db_path, table_a)
+    b = read_edition_hashes(db_path, table_b)
+    a_rows, b_rows = find_fuzzy_matches(db_path, table_b, a, b)
+    valid_a_rows, valid_b_rows = find_valid_matches(a, b, a_rows, b_rows)
+    if not len(valid_a_rows):
+        # with nothing in common, hashing every frame of both would only find that they differ throughout
+        return [], []
+
+    dropped = ~np.isin(a_rows, valid_a_rows)
+    regions = find_candidate_regions(create_hash_matches(a, b, valid_a_rows, valid_b_rows),
+                                     create_hash_matches(a, b, a_rows[dropped], b_rows[dropped]),
+                                     get_frame_count(video_a), get_frame_count(video_b))
+    for (video_path, table_name), table_regions in zip(editions, regions):
+        table_regions = [(start, end) for start, end in table_regions if start < end]
+        if table_regions:
+            hash_video_frames_to_db(video_path, db_path, table_name, workers, max_memory, backend, resume=True,
+                                    selection=FrameSelection(1, table_regions))
+    return regions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Prepass',
+        description='Hashes a sample of the frames of two editions, and then every frame of the regions in which they '
+                    'may differ, for a quick first comparison'
+    )
+
+    parser.add_argument('video_a', help="Path to the video file of the first edition")
+    parser.add_argument('table_a', help="Name of the table to save the first edition's data to")
+    parser.add_argument('video_b', help="Path to the video file of the second edition")
+    parser.add_argument('table_b', help="Name of the table to save the second edition's data to")
+    parser.add_argument('--db', default="data/frame_hashes.db", help="Path to database file")
+    parser.add_argument('--step', default=10, type=int,
+                        help="Hash only every nth frame of the first edition outside of candidate regions")
+    parser.add_argument('--burst-every', default=5, type=int,
+                        help="Hash only a burst of step consecutive frames every this many steps of the second "
+                             "edition outside of candidate regions")
+    parser.add_argument('--threads', default=4, type=int, help="Number of threads, or processes, to use")
+    parser.add_argument('--backend', default="thread", choices=["thread", "process"],
+                        help="Hash frames on a thread pool, or on a process pool fed through shared memory")
+    parser.add_argument('--max-memory', default=2048, type=int,
+                        help="Maximum memory in MB to use for frames waiting to be hashed")
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+
+    regions, _ = run_prepass(args.video_a, args.table_a, args.video_b, args.table_b, args.db, args.step,
+                             args.burst_every, args.threads, args.max_memory, args.backend)
+    print(f"Found {len(regions)} candidate regions")
+
+    print(f"Took {datetime.now() - start_time}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import heapq
+from dataclasses import dataclass
+from typing import Callable
+
+import numpy as np
+from numpy import ndarray
+
+maximum_run_gap = 240 # how many frames may separate two matches with the same offset for them to be in the same scene
+minimum_run_matches = 3 # how many matches a scene needs, so that stray matches aren't mistaken for moved scenes
+
+
+@dataclass
+class Scene:
+    # frames from each start up to but excluding each end
+    a_start: int
+    a_end: int
+    b_start: int
+    b_end: int
+    type: str = "same"
+    matches: int = 0
+
+    @property
+    def offset(self) -> int:
+        return self.b_start - self.a_start
+
+
+def get_run_bounds(breaks: ndarray) -> tuple[ndarray, ndarray]:
+    # the start and end of each run of sorted matches, from whether each match is in a different run to the one before
+    positions = np.flatnonzero(breaks) + 1
+    return np.concatenate([[0], positions]), np.concatenate([positions, [len(breaks) + 1]])
+
+
+def count_between(indexes: ndarray, counted: ndarray) -> ndarray:
+    # how many counted frames are between each frame and the next, not including either
+    counted_indexes = np.sort(indexes[counted])
+    return np.searchsorted(counted_indexes, indexes[1:], side="left") \
+        - np.searchsorted(counted_indexes, indexes[:-1], side="right")
+
+
+def find_runs(a_indexes: ndarray, b_indexes: ndarray) -> list[Scene]:
+    """
+    Groups matched frames into runs along a diagonal, where the frames of both editions advance together with a
+    constant offset between them, wherever those runs are in either edition. Matches with the same offset are in the
+    same run while they're close together, but not when a run at another offset is between them in either edition, as
+    the same offset either side of a moved scene is two scenes.
+    """
+    if not len(a_indexes):
+        return []
+
+    offsets = b_indexes - a_indexes
+    order = np.lexsort((a_indexes, offsets))
+    a_sorted = a_indexes[order]
+    b_sorted = b_indexes[order]
+    offsets = offsets[order]
+
+    breaks = (np.diff(offsets) != 0) | (np.diff(a_sorted) > maximum_run_gap)
+    starts, ends = get_run_bounds(breaks)
+    in_run = np.repeat(ends - starts >= minimum_run_matches, ends - starts)
+    breaks |= (count_between(a_sorted, in_run) > 0) | (count_between(b_sorted, in_run) > 0)
+    starts, ends = get_run_bounds(breaks)
+    keep = ends - starts >= minimum_run_matches
+
+    runs = []
+    for start, end in zip(starts[keep].tolist(), ends[keep].tolist()):
+        a_start = int(a_sorted[start])
+        a_end = int(a_sorted[end - 1]) + 1
+        offset = int(offsets[start])
+        runs.append(Scene(a_start, a_end, a_start + offset, a_end + offset, matches=end - start))
+    return sorted(runs, key=lambda x: x.a_start)
+
+
+class PrefixMaximum:
+    """
+    A Fenwick tree of the best chain ending at each rank, answering the best chain ending at or below a rank.
+    """
+
+    def __init__(self, size: int):
+        self.tree = [(0, -1)] * (size + 1)
+
+    def update(self, rank: int, value: tuple[int, int]):
+        rank += 1
+        while rank < len(self.tree):
+            self.tree[rank] = max(self.tree[rank], value)
+            rank += rank & -rank
+
+    def query(self, rank: int) -> tuple[int, int]:
+        best = (0, -1)
+        while rank > 0:
+            best = max(best, self.tree[rank])
+            rank -= rank & -rank
+        return best
+
+
+def find_ordered_runs(runs: list[Scene]) -> list[int]:
+    """
+    Finds the chain of runs, in order in both editions without overlapping, with the most matched frames. Runs are
+    sorted by their start in a, and each run only becomes a candidate predecessor once a has passed its end.
+    """
+    b_ends = sorted({x.b_end for x in runs})
+    ranks = {b_end: rank for rank, b_end in enumerate(b_ends)}
+    prefix_maximum = PrefixMaximum(len(b_ends))
+
+    best = [0] * len(runs)
+    previous = [-1] * len(runs)
+    pending = []
+    for j, run in enumerate(runs):
+        while pending and pending[0][0] <= run.a_start:
+            _, i = heapq.heappop(pending)
+            prefix_maximum.update(ranks[runs[i].b_end], (best[i], i))
+
+        weight, i = prefix_maximum.query(np.searchsorted(b_ends, run.b_start, side="right"))
+        best[j] = weight + run.matches
+        previous[j] = i
+        heapq.heappush(pending, (run.a_end, j))
+
+    chain = []
+    j = int(np.argmax(best)) if runs else -1
+    while j >= 0:
+        chain.append(j)
+        j = previous[j]
+    return chain[::-1]
+
+
+def subtract(start: int, end: int, covered: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    # the parts of the frames from start to end which aren't covered by any of the sorted ranges
+    pieces = []
+    for covered_start, covered_end in covered:
+        if covered_end <= start or covered_start >= end:
+            continue
+        if covered_start > start:
+            pieces.append((start, covered_start))
+        start = max(start, covered_end)
+    if start < end:
+        pieces.append((start, end))
+    return pieces
+
+
+def overlaps(start: int, end: int, covered: list[tuple[int, int]]) -> bool:
+    return any(covered_start < end and covered_end > start for covered_start, covered_end in covered)
+
+
+def extend_scene(scene: Scene, others: list[Scene], is_similar: Callable[[int, int], bool]):
+    # over the frames either side of it which are similar at its offset, and aren't part of another scene in either
+    # edition
+    a_covered = [(x.a_start, x.a_end) for x in others]
+    b_covered = [(x.b_start, x.b_end) for x in others]
+    while not overlaps(scene.a_start - 1, scene.a_start, a_covered) \
+            and not overlaps(scene.b_start - 1, scene.b_start, b_covered) \
+            and is_similar(scene.a_start - 1, scene.b_start - 1):
+        scene.a_start -= 1
+        scene.b_start -= 1
+    while not overlaps(scene.a_end, scene.a_end + 1, a_covered) \
+            and not overlaps(scene.b_end, scene.b_end + 1, b_covered) \
+            and is_similar(scene.a_end, scene.b_end):
+        scene.a_end += 1
+        scene.b_end += 1
+
+
+def align_scenes(a_indexes: ndarray, b_indexes: ndarray, a_bounds: tuple[int, int], b_bounds: tuple[int, int],
+                 refine_gap: Callable[[Scene], Scene | None] | None = None,
+                 is_similar: Callable[[int, int], bool] | None = None) -> list[Scene]:
+    """
+    Aligns two editions by scene from their matched frames, without assuming that scenes appear in the same order.
+
+    Scenes in the longest ordered chain are common to both editions, and any other scene is reported as moved. The
+    frames between two consecutive common scenes, which aren't part of a moved scene, are reported as new when only one
+    edition has any, or different when both do. A gap between common scenes with no moved scene in it is first given
+    to refine_gap, which may narrow it to where the editions really differ, or find that they don't. Beforehand, a
+    scene whose first or last frames weren't matched is extended over them, for as long as is_similar finds each frame
+    of a similar to the frame of b at the scene's offset, as a gap beside a moved scene isn't refined. Consecutive common
+    scenes with the same offset are treated as one scene, so, as when matching in order, content replaced by another of
+    exactly the same length isn't reported.
+    """
+    runs = find_runs(a_indexes, b_indexes)
+    chain = find_ordered_runs(runs)
+    in_chain = set(chain)
+    if is_similar is not None:
+        for run in runs:
+            extend_scene(run, [x for x in runs if x is not run], is_similar)
+    moved = [Scene(x.a_start, x.a_end, x.b_start, x.b_end, "moved") for i, x in enumerate(runs) if i not in in_chain]
+    a_moved = sorted((x.a_start, x.a_end) for x in moved)
+    b_moved = sorted((x.b_start, x.b_end) for x in moved)
+
+    common = []
+    for run in (runs[i] for i in chain):
+        if common and common[-1].offset == run.offset \
+                and not overlaps(common[-1].a_end, run.a_start, a_moved) \
+                and not overlaps(common[-1].b_end, run.b_start, b_moved):
+            common[-1].a_end = run.a_end
+            common[-1].b_end = run.b_end
+        else:
+            common.append(Scene(run.a_start, run.a_end, run.b_start, run.b_end))
+
+    # the frames either side of the common scenes, including before the first and after the last
+    a_first, a_last = a_bounds
+    b_first, b_last = b_bounds
+    first = Scene(a_first, a_first, b_first, b_first)
+    last = Scene(a_last + 1, a_last + 1, b_last + 1, b_last + 1)
+    boundaries = [first] + common + [last]
+
+    differences = []
+    for previous, current in zip(boundaries, boundaries[1:]):
+        if refine_gap is not None and not overlaps(previous.a_end, current.a_start, a_moved) \
+                and not overlaps(previous.b_end, current.b_start, b_moved):
+            gap = Scene(previous.a_end, current.a_start, previous.b_end, current.b_start, "different")
+            refined = refine_gap(gap) if gap.a_start < gap.a_end or gap.b_start < gap.b_end else None
+            if refined is not None:
+                differences.append(refined)
+            continue
+
+        a_pieces = subtract(previous.a_end, current.a_start, a_moved)
+        b_pieces = subtract(previous.b_end, current.b_start, b_moved)
+        if a_pieces and b_pieces:
+            differences.append(Scene(a_pieces[0][0], a_pieces[-1][1], b_pieces[0][0], b_pieces[-1][1], "different"))
+        elif a_pieces:
+            differences.extend(Scene(start, end, previous.b_end, previous.b_end, "new") for start, end in a_pieces)
+        elif b_pieces:
+            differences.extend(Scene(previous.a_end, previous.a_end, start, end, "new") for start, end in b_pieces)
+
+    return sorted(differences + moved, key=lambda x: (x.a_start, x.b_start))